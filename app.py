@@ -1,17 +1,44 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, send_from_directory, make_response
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, send_from_directory, send_file, make_response, g, has_app_context
+from markupsafe import Markup, escape
 import os
 import json
+import csv
+import io
 import requests
 import base64
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+import click
 from flask_socketio import SocketIO, emit, join_room, leave_room
+from socketio import PubSubManager
 import secrets
 import re
 import sqlite3
 from functools import wraps
 import random
 import string
+import threading
+import bisect
+import hashlib
+import html
+import queue
+import time
+import socket
+import gzip
+import zlib
+import mimetypes
+from urllib.parse import urlparse
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # brotli variants are skipped, gzip still works
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # responsive_image() falls back to a plain <img>
+    Image = None
 
 # Load environment variables
 load_dotenv()
@@ -20,7 +47,563 @@ app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY')
 app.config['PREFERED_URL_SCHEME'] = 'https'  # Force HTTPS in production
 app.config['SESSION_COOKIE_SECURE'] = True  # Use secure cookies in production
-socketio = SocketIO(app, cors_allowed_origins="*")
+
+class UnixSocketManager(PubSubManager):
+    """Socket.IO fan-out between worker processes on one host, no broker needed.
+
+    Every process binds a datagram socket in a shared directory and publishes
+    by sending to all the other sockets there. Sockets left behind by dead
+    processes are removed on the next publish.
+    """
+    name = 'unix'
+    max_message_size = 1024 * 1024
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.directory = os.path.join(urlparse(url).path or '/tmp/bass42-socketio', channel)
+        self.path = None
+        self.sock = None
+
+    def _connect(self):
+        if self.sock is None:
+            os.makedirs(self.directory, exist_ok=True)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.max_message_size)
+            if not self.write_only:
+                self.path = os.path.join(self.directory, f'{os.getpid()}-{secrets.token_hex(4)}.sock')
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.max_message_size)
+                sock.bind(self.path)
+            self.sock = sock
+        return self.sock
+
+    def _publish(self, data):
+        sock = self._connect()
+        payload = self.json.dumps(data).encode()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == self.path:
+                continue
+            try:
+                sock.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nobody is listening there any more
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                self._get_logger().error(f'Cannot publish to {path}: {e}')
+
+    def _listen(self):
+        sock = self._connect()
+        while True:
+            data, _ = sock.recvfrom(self.max_message_size)
+            yield data.decode()
+
+def socketio_options():
+    """Message bus for fanning Socket.IO events out across workers.
+
+    SOCKETIO_MESSAGE_QUEUE can be unset (one process), unix:///some/dir for
+    workers on one host, or a broker URL such as redis://host:6379/0 (needs the
+    matching client package) for several hosts.
+    """
+    url = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    if not url:
+        return {}
+    if url.startswith('unix://'):
+        return {'client_manager': UnixSocketManager(url)}
+    return {'message_queue': url}
+
+# Response compression
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))  # gzip, 1-9
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))  # 0-11
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))  # bytes
+COMPRESS_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/xml', 'text/javascript',
+    'application/javascript', 'application/json', 'application/x-ndjson', 'application/xml',
+    'image/svg+xml',
+}
+
+class CompressionMiddleware:
+    """Compress text responses with brotli or gzip, as the client accepts.
+
+    Bodies are compressed chunk by chunk and flushed after each one, so
+    streamed responses (e.g. the exports) still reach the client as they are
+    produced. Responses below COMPRESS_MIN_SIZE, of other content types, or
+    already encoded (precompressed static files) are passed through, as are
+    HEAD requests and Socket.IO traffic.
+    """
+
+    def __init__(self, wsgi_app, level=COMPRESS_LEVEL, brotli_quality=COMPRESS_BROTLI_QUALITY,
+                 min_size=COMPRESS_MIN_SIZE, mimetypes=COMPRESS_MIMETYPES):
+        self.wsgi_app = wsgi_app
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.min_size = min_size
+        self.mimetypes = mimetypes
+
+    def negotiate(self, environ):
+        if environ.get('REQUEST_METHOD') == 'HEAD' or environ.get('PATH_INFO', '').startswith('/socket.io'):
+            return None
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli and accepted['br']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def should_compress(self, status, headers):
+        code = int(status.split(' ', 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        fields = {name.lower(): value for name, value in headers}
+        if 'content-encoding' in fields or 'no-transform' in fields.get('cache-control', ''):
+            return False
+        if fields.get('content-type', '').split(';')[0].strip() not in self.mimetypes:
+            return False
+        length = fields.get('content-length')
+        # Streamed responses have no length and are always worth compressing
+        return length is None or int(length) >= self.min_size
+
+    def compressed_headers(self, headers, encoding):
+        result = []
+        vary = None
+        for name, value in headers:
+            lower = name.lower()
+            if lower == 'content-length':
+                continue
+            if lower == 'vary':
+                vary = value
+                continue
+            if lower == 'etag' and not value.startswith('W/'):
+                # The bytes differ from the identity response; a weak ETag
+                # still lets If-None-Match revalidation answer 304
+                value = f'W/{value}'
+            result.append((name, value))
+        if vary and 'accept-encoding' not in vary.lower():
+            vary = f'{vary}, Accept-Encoding'
+        result.append(('Vary', vary or 'Accept-Encoding'))
+        result.append(('Content-Encoding', encoding))
+        return result
+
+    def compress(self, body, encoding):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            process, flush, finish = compressor.process, compressor.flush, compressor.finish
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)  # 31: gzip container
+            process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+        try:
+            for chunk in body:
+                if chunk:
+                    data = process(chunk) + flush()
+                    if data:
+                        yield data
+            yield finish()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ)
+        if encoding is None:
+            return self.wsgi_app(environ, start_response)
+        
+        compressing = []
+        def start(status, headers, exc_info=None):
+            if self.should_compress(status, headers):
+                headers = self.compressed_headers(headers, encoding)
+                compressing.append(True)
+            return start_response(status, headers, exc_info)
+        
+        body = self.wsgi_app(environ, start)
+        if not compressing:
+            return body
+        return self.compress(body, encoding)
+
+# Installed before Socket.IO wraps the app, so Socket.IO requests never reach it
+app.wsgi_app = CompressionMiddleware(app.wsgi_app)
+
+# SOCKETIO_ASYNC_MODE overrides the auto-detected mode, e.g. 'threading' when
+# running under a threaded gunicorn worker with eventlet installed
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=os.environ.get('SOCKETIO_ASYNC_MODE'),
+                    **socketio_options())
+
+# Metrics, served in Prometheus text format by /metrics
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # lets a scraper in without an admin session
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+class MetricsRegistry:
+    """Counters, gauges and latency histograms for this worker process.
+
+    An update is a dict lookup and an addition under one lock, cheap enough to
+    leave on permanently. Labels are tuples of (name, value) pairs; endpoints
+    are labelled by their URL rule so the number of series stays bounded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._series = {}
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+        self._series[name] = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            series = self._series[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        with self._lock:
+            self._series[name][labels] = value
+
+    def observe(self, name, labels, seconds):
+        with self._lock:
+            series = self._series[name]
+            counts = series.get(labels)
+            if counts is None:
+                # One slot per bucket plus +Inf, then sum and count
+                counts = series[labels] = [0] * (len(LATENCY_BUCKETS) + 3)
+            counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            counts[-2] += seconds
+            counts[-1] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in self._meta.items():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in self._series[name].items():
+                    if kind != 'histogram':
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+                        continue
+                    total = 0
+                    for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value):
+                        total += count
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {total}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {value[-2]}')
+                    lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.describe('http_requests_total', 'counter', 'HTTP requests by endpoint, method and status code.')
+metrics.describe('http_request_duration_seconds', 'histogram', 'HTTP request latency by endpoint and method.')
+metrics.describe('http_requests_in_flight', 'gauge', 'HTTP requests currently being handled.')
+metrics.describe('sqlite_queries_total', 'counter', 'SQLite statements executed, by endpoint.')
+metrics.describe('sqlite_query_seconds_total', 'counter', 'Time spent executing SQLite statements, by endpoint.')
+metrics.describe('sqlite_slow_queries_total', 'counter', 'SQLite statements slower than SLOW_QUERY_MS.')
+metrics.describe('mpesa_requests_total', 'counter', 'Daraja API calls by call and HTTP status.')
+metrics.describe('mpesa_request_duration_seconds', 'histogram', 'Daraja API call latency.')
+metrics.describe('mpesa_circuit_state', 'gauge', 'Daraja circuit breaker state: 0 closed, 1 half-open, 2 open.')
+metrics.describe('mpesa_circuit_rejections_total', 'counter', 'Daraja calls refused because the circuit breaker was open.')
+metrics.describe('json_store_loads_total', 'counter', 'JSON data files read.')
+metrics.describe('json_store_load_bytes_total', 'counter', 'Bytes read from JSON data files.')
+metrics.describe('socketio_connected_clients', 'gauge', 'Socket.IO clients connected to this worker.')
+metrics.describe('socketio_events_total', 'counter', 'Socket.IO events handled, by event.')
+metrics.describe('socketio_event_duration_seconds', 'histogram', 'Socket.IO event handler latency.')
+
+def request_endpoint():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    g._request_started = time.perf_counter()
+    g._db_queries = 0
+    g._db_seconds = 0.0
+    metrics.inc('http_requests_in_flight')
+
+@app.after_request
+def record_response_status(response):
+    g._response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    started = g.pop('_request_started', None)
+    if started is None:
+        # Socket.IO events also push a request context but skip before_request
+        return
+    endpoint = request_endpoint()
+    status = g.pop('_response_status', 500)
+    metrics.inc('http_requests_in_flight', value=-1)
+    metrics.inc('http_requests_total', (('endpoint', endpoint), ('method', request.method), ('status', status)))
+    metrics.observe('http_request_duration_seconds', (('endpoint', endpoint), ('method', request.method)),
+                    time.perf_counter() - started)
+    if g._db_queries:
+        metrics.inc('sqlite_queries_total', (('endpoint', endpoint),), g._db_queries)
+        metrics.inc('sqlite_query_seconds_total', (('endpoint', endpoint),), g._db_seconds)
+
+def record_db_query(seconds):
+    """Count a statement against the current request, or as background work"""
+    if has_app_context() and '_db_queries' in g:
+        g._db_queries += 1
+        g._db_seconds += seconds
+    else:
+        metrics.inc('sqlite_queries_total', (('endpoint', 'background'),))
+        metrics.inc('sqlite_query_seconds_total', (('endpoint', 'background'),), seconds)
+
+def timed_mpesa_call(call, send):
+    """Run a Daraja request, recording its latency and HTTP status"""
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        response = send()
+        status = response.status_code
+        return response
+    finally:
+        metrics.observe('mpesa_request_duration_seconds', (('call', call),), time.perf_counter() - started)
+        metrics.inc('mpesa_requests_total', (('call', call), ('status', status)))
+
+def socket_metrics(event):
+    """Wrap a Socket.IO handler to count and time its events"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                metrics.inc('socketio_events_total', (('event', event),))
+                metrics.observe('socketio_event_duration_seconds', (('event', event),),
+                                time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+# Static assets: fingerprinted names, precompressed variants, immutable caching
+STATIC_BUILD_DIR = os.path.join(app.root_path, 'static_build')
+STATIC_COMPRESS_TYPES = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+STATIC_COMPRESS_MIN_SIZE = 1024
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+def fingerprinted_name(filename, digest):
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}.{digest}{ext}'
+
+def write_atomic(path, data):
+    """Write a file so that other workers never see it half written"""
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def build_static_assets():
+    """Content-hash every static file and write gzip/brotli variants of text assets.
+
+    Returns the manifest {filename: fingerprinted filename}. Variants are
+    named after the hash, so unchanged files are not compressed again.
+    """
+    manifest = {}
+    static_folder = app.static_folder
+    os.makedirs(STATIC_BUILD_DIR, exist_ok=True)
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            hashed = fingerprinted_name(filename, hashlib.sha256(data).hexdigest()[:10])
+            manifest[filename] = hashed
+            
+            if not filename.endswith(STATIC_COMPRESS_TYPES) or len(data) < STATIC_COMPRESS_MIN_SIZE:
+                continue
+            target = os.path.join(STATIC_BUILD_DIR, hashed.replace('/', os.sep))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if not os.path.exists(f'{target}.gz'):
+                write_atomic(f'{target}.gz', gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli and not os.path.exists(f'{target}.br'):
+                write_atomic(f'{target}.br', brotli.compress(data, quality=11))
+    return manifest
+
+try:
+    static_manifest = build_static_assets()
+except OSError as e:
+    print(f"Error building static assets: {e}")
+    static_manifest = {}
+static_originals = {hashed: filename for filename, hashed in static_manifest.items()}
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    """Point url_for('static', filename=...) at the fingerprinted file name"""
+    if endpoint == 'static' and 'filename' in values:
+        filename = values['filename'].lstrip('/')
+        values['filename'] = static_manifest.get(filename, values['filename'])
+
+def serve_static(filename):
+    """Serve fingerprinted assets precompressed and cached for a year, others as usual"""
+    original = static_originals.get(filename)
+    if original is None:
+        return app.send_static_file(filename)
+    
+    path = os.path.join(app.static_folder, original)
+    encoding = None
+    variant = os.path.join(STATIC_BUILD_DIR, filename)
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[candidate] and os.path.exists(variant + suffix):
+            path, encoding = variant + suffix, candidate
+            break
+    
+    response = send_file(path, mimetype=mimetypes.guess_type(original)[0], max_age=STATIC_MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if original.endswith(STATIC_COMPRESS_TYPES):
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+app.view_functions['static'] = serve_static
+
+# Responsive images: resized and WebP variants of static/images, made on first
+# request (or by 'flask build-images') and cached under content-hashed names
+IMAGE_WIDTHS = (320, 480, 640, 960, 1280)
+IMAGE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG'}
+IMAGE_QUALITY = {'JPEG': 80, 'WEBP': 75}
+
+_image_sizes = {}
+_image_build_lock = threading.Lock()
+# Fingerprinted name without extension -> source file, e.g. images/hero.26eaf50bd6 -> images/hero.jpg
+image_sources = {os.path.splitext(hashed)[0]: filename for filename, hashed in static_manifest.items()
+                 if filename.startswith('images/') and os.path.splitext(filename)[1].lower() in IMAGE_FORMATS}
+
+def image_size(filename):
+    """(width, height) of a source image as displayed, after EXIF rotation"""
+    if filename not in _image_sizes:
+        with Image.open(os.path.join(app.static_folder, filename)) as img:
+            width, height = img.size
+            if img.getexif().get(0x0112) in (5, 6, 7, 8):
+                width, height = height, width
+        _image_sizes[filename] = (width, height)
+    return _image_sizes[filename]
+
+def image_variant_widths(filename, ext):
+    """Variant widths made for an image in the given format.
+
+    Standard widths below the image's own; WebP also gets a full-size copy
+    unless the source is wider than the largest standard width. The source
+    format's full size is the original file itself.
+    """
+    width = image_size(filename)[0]
+    widths = [w for w in IMAGE_WIDTHS if w < width]
+    if ext == '.webp' and width <= IMAGE_WIDTHS[-1]:
+        widths.append(width)
+    return widths
+
+def image_variant_name(filename, width, ext):
+    return f'{os.path.splitext(static_manifest[filename])[0]}.w{width}{ext}'
+
+def render_image_variant(source, target, width, image_format):
+    with Image.open(source) as img:
+        # Let the JPEG decoder scale down while reading, whatever the orientation
+        img.draft('RGB', (width, width))
+        img = ImageOps.exif_transpose(img)
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        if image_format == 'JPEG' or img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGB' if image_format == 'JPEG' else 'RGBA')
+        buffer = io.BytesIO()
+        if image_format == 'PNG':
+            img.save(buffer, 'PNG', optimize=True)
+        else:
+            img.save(buffer, image_format, quality=IMAGE_QUALITY[image_format],
+                     optimize=True, progressive=True, method=4)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    write_atomic(target, buffer.getvalue())
+
+def image_variant_path(name):
+    """Disk path of a variant such as images/hero.26eaf50bd6.w640.webp, built if missing.
+
+    Returns None for names that don't match a source image and an offered width.
+    """
+    match = re.fullmatch(r'(?P<base>.+)\.w(?P<width>\d+)(?P<ext>\.[a-z]+)', name)
+    if not match or Image is None:
+        return None
+    filename = image_sources.get(match['base'])
+    if filename is None:
+        return None
+    source_ext = os.path.splitext(filename)[1].lower()
+    if match['ext'] not in ('.webp', source_ext) or int(match['width']) not in image_variant_widths(filename, match['ext']):
+        return None
+    
+    target = os.path.join(STATIC_BUILD_DIR, name.replace('/', os.sep))
+    if not os.path.exists(target):
+        with _image_build_lock:
+            if not os.path.exists(target):
+                image_format = 'WEBP' if match['ext'] == '.webp' else IMAGE_FORMATS[source_ext]
+                render_image_variant(os.path.join(app.static_folder, filename), target,
+                                     int(match['width']), image_format)
+    return target
+
+@app.route('/img/<path:name>')
+def image_variant(name):
+    """Serve a resized/WebP image variant, cached for a year"""
+    try:
+        path = image_variant_path(name)
+    except OSError as e:
+        print(f"Error building image variant {name}: {e}")
+        path = None
+    if path is None:
+        return jsonify({'error': 'Not found'}), 404
+    response = send_file(path, mimetype=mimetypes.guess_type(name)[0], max_age=STATIC_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# Only <img> tags use this. hero.jpg appears on the homepage only as the og:image
+# (the inline .hero rule is a gradient), so it has no CSS image-set() variant.
+@app.template_global()
+def responsive_image(filename, sizes='100vw', **attrs):
+    """An <img> (in a <picture> with a WebP source) offering resized variants.
+
+    Extra keyword arguments become attributes of the <img>. Without Pillow, or
+    for files that aren't in static/images, this is a plain <img>.
+    """
+    attributes = ''.join(f' {name.rstrip("_")}="{escape(value)}"' for name, value in attrs.items())
+    src = url_for('static', filename=filename)
+    if Image is None or os.path.splitext(static_manifest.get(filename, ''))[0] not in image_sources:
+        return Markup(f'<img src="{escape(src)}"{attributes}>')
+    
+    ext = os.path.splitext(filename)[1].lower()
+    try:
+        full_width = image_size(filename)[0]
+    except OSError as e:
+        print(f"Error reading image {filename}: {e}")
+        return Markup(f'<img src="{escape(src)}"{attributes}>')
+    candidates = lambda variant_ext: [
+        f"{url_for('image_variant', name=image_variant_name(filename, width, variant_ext))} {width}w"
+        for width in image_variant_widths(filename, variant_ext)]
+    webp_srcset = ', '.join(candidates('.webp'))
+    img_srcset = ', '.join(candidates(ext) + [f'{src} {full_width}w'])
+    return Markup(f'<picture><source type="image/webp" srcset="{escape(webp_srcset)}" sizes="{escape(sizes)}">'
+                  f'<img src="{escape(src)}" srcset="{escape(img_srcset)}" sizes="{escape(sizes)}"{attributes}>'
+                  f'</picture>')
+
+@app.cli.command('build-images')
+def build_images_command():
+    """Make every responsive image variant ahead of the first request."""
+    if Image is None:
+        print('Pillow is not installed, skipping image variants')
+        return
+    for filename in sorted(image_sources.values()):
+        ext = os.path.splitext(filename)[1].lower()
+        for variant_ext in ('.webp', ext):
+            for width in image_variant_widths(filename, variant_ext):
+                image_variant_path(image_variant_name(filename, width, variant_ext))
+        print(f'{filename}: {", ".join(map(str, image_variant_widths(filename, ".webp")))}')
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress the static files."""
+    for filename, hashed in sorted(build_static_assets().items()):
+        print(f'{filename} -> {hashed}')
 
 # M-Pesa Configuration
 MPESA_CONSUMER_KEY = os.environ.get('MPESA_CONSUMER_KEY')
@@ -29,6 +612,17 @@ MPESA_SHORTCODE = os.environ.get('MPESA_SHORTCODE')
 MPESA_PASSKEY = os.environ.get('MPESA_PASSKEY')
 MPESA_CALLBACK_URL = os.environ.get('MPESA_CALLBACK_URL')
 ACCOUNT_REFERENCE = os.environ.get('ACCOUNT_REFERENCE')
+# For production, use: https://api.safaricom.co.ke
+MPESA_BASE_URL = os.environ.get('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke').rstrip('/')
+MPESA_TOKEN_REFRESH_MARGIN = 60  # seconds before expiry to fetch a new token
+# Every Daraja call is bounded so a hung connection cannot pin a worker
+MPESA_CONNECT_TIMEOUT = float(os.environ.get('MPESA_CONNECT_TIMEOUT', 3.05))
+MPESA_READ_TIMEOUT = float(os.environ.get('MPESA_READ_TIMEOUT', 10))
+MPESA_TOKEN_RETRIES = int(os.environ.get('MPESA_TOKEN_RETRIES', 2))
+MPESA_RETRY_BACKOFF = float(os.environ.get('MPESA_RETRY_BACKOFF', 0.5))  # seconds, doubled per retry
+MPESA_BREAKER_THRESHOLD = int(os.environ.get('MPESA_BREAKER_THRESHOLD', 5))  # consecutive failures
+MPESA_BREAKER_RESET = float(os.environ.get('MPESA_BREAKER_RESET', 30))  # seconds before a trial call
+MPESA_UNAVAILABLE_MESSAGE = 'M-Pesa is temporarily unavailable. Please try again in a few minutes.'
 
 # Admin credentials
 ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME')
@@ -42,46 +636,298 @@ ALUMNI_DATA_FILE = 'alumni_data.json'
 def load_data(filename):
     """Load data from JSON file"""
     if os.path.exists(filename):
-        with open(filename, 'r') as f:
-            return json.load(f)
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        metrics.inc('json_store_loads_total', (('file', filename),))
+        metrics.inc('json_store_load_bytes_total', (('file', filename),), len(raw))
+        return json.loads(raw)
     return []
 
+def query_store(sql, params=()):
+    """Run a SELECT against the storage tables and return rows as dicts"""
+    c = get_db().cursor()
+    c.row_factory = sqlite3.Row
+    c.execute(sql, params)
+    return [dict(row) for row in c.fetchall()]
+
+class FrozenRecord(dict):
+    """A read-only dict, so handlers can't modify records shared through the store cache"""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('cached records are read-only, copy with dict(record) first')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+_store_cache = {}
+
+def store_version(table):
+    """Get a table's write counter (bumped by triggers on every change)"""
+    c = get_db().cursor()
+    c.execute('SELECT version FROM store_versions WHERE store = ?', (table,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def cached_store(table, sql):
+    """Return a shared, read-only snapshot of a table's rows.
+
+    The snapshot is only rebuilt when the table's version has moved on, so
+    repeated reads cost a single primary-key lookup. The version lives in the
+    database, so writes from other workers invalidate it too.
+    """
+    version = store_version(table)
+    cached = _store_cache.get(table)
+    if cached and cached[0] == version:
+        return cached[1]
+    snapshot = tuple(FrozenRecord(record) for record in query_store(sql))
+    _store_cache[table] = (version, snapshot)
+    return snapshot
+
+def insert_record(table, record):
+    """Insert a record and return its autoincrement id"""
+    columns = ', '.join(record)
+    placeholders = ', '.join('?' * len(record))
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', tuple(record.values()))
+    conn.commit()
+    return c.lastrowid
+
+def update_record(table, record_id, fields):
+    """Update some columns of one record by id"""
+    assignments = ', '.join(f'{column} = ?' for column in fields)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(f'UPDATE {table} SET {assignments} WHERE id = ?', tuple(fields.values()) + (record_id,))
+    conn.commit()
+    return c.rowcount > 0
+
 def load_alumni_data():
-    """Load existing alumni data from JSON file"""
-    if os.path.exists(ALUMNI_DATA_FILE):
-        try:
-            with open(ALUMNI_DATA_FILE, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            return []
-    return []
+    """Load all alumni records"""
+    return cached_store('alumni', 'SELECT * FROM alumni ORDER BY id')
 
-def save_alumni_data(dat):
-    """Save alumni data to JSON file"""
+def add_alumni(record):
+    """Save a new alumni record, returning its id (None on failure)"""
+    index = _alumni_index
     try:
-        with open(ALUMNI_DATA_FILE, 'w') as f:
-            json.dump(dat, f, indent=2)
-        return True
-    except Exception as e:
+        alumni_id = insert_record('alumni', record)
+    except sqlite3.Error as e:
         print(f"Error saving data: {e}")
-        return False
+        return None
+    
+    # Keep the search index current unless another worker also wrote meanwhile
+    if index and store_version('alumni') == index.version + 1:
+        index.add(FrozenRecord(record, id=alumni_id))
+        index.version += 1
+    return alumni_id
+
+class AlumniIndex:
+    """In-memory search index over the alumni records.
 
-def save_data(data, filename):
-    """Save data to JSON file"""
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=2)
+    Names are split into lowercase tokens kept in a sorted list, so a prefix
+    search is two bisects. Years are kept as sorted (year, id) pairs for range
+    lookups and phones are hashed by their normalized form.
+    """
+
+    def __init__(self, records, version):
+        self.version = version
+        self.records = {}
+        self.tokens = {}
+        self.sorted_tokens = []
+        self.year_started = []
+        self.year_finished = []
+        self.phones = {}
+        for record in records:
+            self.add(record)
+
+    @staticmethod
+    def name_tokens(name):
+        return set(re.findall(r'\w+', name.lower()))
+
+    @staticmethod
+    def normalize_phone(phone):
+        return validate_phone_number(str(phone)) or re.sub(r'[^\d]', '', str(phone))
+
+    def add(self, record):
+        alumni_id = record['id']
+        self.records[alumni_id] = record
+        for token in self.name_tokens(record['name']):
+            if token not in self.tokens:
+                self.tokens[token] = set()
+                bisect.insort(self.sorted_tokens, token)
+            self.tokens[token].add(alumni_id)
+        bisect.insort(self.year_started, (record['year_started'], alumni_id))
+        bisect.insort(self.year_finished, (record['year_finished'], alumni_id))
+        self.phones.setdefault(self.normalize_phone(record['phone']), set()).add(alumni_id)
+
+    def prefix_ids(self, prefix):
+        """Ids of alumni with a name token starting with prefix"""
+        start = bisect.bisect_left(self.sorted_tokens, prefix)
+        # Every token with this prefix sorts before prefix + the highest code point
+        end = bisect.bisect_left(self.sorted_tokens, prefix + '\U0010ffff', start)
+        ids = set()
+        for i in range(start, end):
+            ids |= self.tokens[self.sorted_tokens[i]]
+        return ids
+
+    @staticmethod
+    def range_ids(years, low, high):
+        start = bisect.bisect_left(years, (low, 0)) if low is not None else 0
+        end = bisect.bisect_right(years, (high, float('inf'))) if high is not None else len(years)
+        return {alumni_id for _, alumni_id in years[start:end]}
+
+    def search(self, q=None, phone=None, year_started=(None, None), year_finished=(None, None)):
+        """Ids matching every given criterion, in id order"""
+        matches = None
+        
+        def narrow(ids):
+            return ids if matches is None else matches & ids
+        
+        for token in self.name_tokens(q or ''):
+            matches = narrow(self.prefix_ids(token))
+        if phone:
+            matches = narrow(self.phones.get(self.normalize_phone(phone), set()))
+        if year_started != (None, None):
+            matches = narrow(self.range_ids(self.year_started, *year_started))
+        if year_finished != (None, None):
+            matches = narrow(self.range_ids(self.year_finished, *year_finished))
+        return sorted(self.records if matches is None else matches)
+
+_alumni_index = None
+
+def get_alumni_index():
+    """Get the alumni search index, rebuilding it if the table changed elsewhere"""
+    global _alumni_index
+    version = store_version('alumni')
+    if _alumni_index is None or _alumni_index.version != version:
+        _alumni_index = AlumniIndex(load_alumni_data(), version)
+    return _alumni_index
 
 def load_announcements():
-    return load_data(ANNOUNCEMENTS_FILE)
+    """Load announcements, newest first"""
+    return cached_store('announcements', 'SELECT id, title, content, date FROM announcements ORDER BY id DESC')
+
+def add_announcement_record(record):
+    return insert_record('announcements', record)
+
+def delete_announcement_record(announcement_id):
+    conn = get_db()
+    conn.execute('DELETE FROM announcements WHERE id = ?', (announcement_id,))
+    conn.commit()
+
+def add_donation(record):
+    """Save a new donation record, returning its id"""
+    return insert_record('donations', record)
 
-def save_announcements(announcements):
-    save_data(announcements, ANNOUNCEMENTS_FILE)
+def update_donation(donation_id, **fields):
+    return update_record('donations', donation_id, fields)
 
-def load_donations():
-    return load_data(DONATIONS_FILE)
+def settle_donation(checkout_request_id, phone=None, amount=None, **fields):
+    """Update the pending donation for an STK push.
 
-def save_donations(donations):
-    save_data(donations, DONATIONS_FILE)
+    A push whose request timed out has no CheckoutRequestID stored, so when
+    phone and amount are given an unknown id falls back to the oldest such
+    unconfirmed donation from the last STK_UNCONFIRMED_WINDOW minutes.
+
+    Returns the donation's reference, or None if no pending donation matches
+    (unknown id, or a duplicate callback).
+    """
+    assignments = ', '.join(f'{column} = ?' for column in fields)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(f'''UPDATE donations SET {assignments}
+                  WHERE checkout_request_id = ? AND status = 'pending' ''',
+              tuple(fields.values()) + (checkout_request_id,))
+    if c.rowcount == 0 and phone and amount is not None:
+        since = (datetime.now() - timedelta(minutes=STK_UNCONFIRMED_WINDOW)).strftime('%Y-%m-%d %H:%M:%S')
+        c.execute(f'''UPDATE donations SET {assignments}, checkout_request_id = ?, error = NULL
+                      WHERE id = (SELECT id FROM donations INDEXED BY idx_donations_unconfirmed
+                                  WHERE status = 'pending' AND checkout_request_id IS NULL
+                                  AND phone = ? AND amount = ? AND error = ? AND date >= ?
+                                  ORDER BY id LIMIT 1)''',
+                  tuple(fields.values()) + (checkout_request_id, str(phone), amount, STK_UNCONFIRMED_ERROR, since))
+    conn.commit()
+    if c.rowcount == 0:
+        return None
+    c.execute('SELECT reference FROM donations WHERE checkout_request_id = ?', (checkout_request_id,))
+    return c.fetchone()[0]
+
+ADMIN_PAGE_SIZE = 20
+ADMIN_MAX_PAGE_SIZE = 100
+
+def query_page(table, columns, filters, sort, order, page, per_page):
+    """Fetch one page of a table along with the total number of matching rows.
+
+    filters is a list of (sql condition, value) pairs, sort must already be a
+    known column name.
+    """
+    where = ' AND '.join(condition for condition, _ in filters) or '1'
+    params = tuple(value for _, value in filters)
+    total = query_store(f'SELECT COUNT(*) AS total FROM {table} WHERE {where}', params)[0]['total']
+    items = query_store(f'''SELECT {columns} FROM {table} WHERE {where}
+                            ORDER BY {sort} {order}, id {order}
+                            LIMIT ? OFFSET ?''', params + (per_page, (page - 1) * per_page))
+    return {
+        'items': items,
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'pages': max(1, -(-total // per_page))
+    }
+
+def page_args(sort_columns, default_sort):
+    """Read page, per_page, sort and order from the query string"""
+    page = max(1, int(request.args.get('page', 1)))
+    per_page = max(1, min(int(request.args.get('per_page', ADMIN_PAGE_SIZE)), ADMIN_MAX_PAGE_SIZE))
+    sort = request.args.get('sort', default_sort)
+    if sort not in sort_columns:
+        raise ValueError(f"sort must be one of: {', '.join(sort_columns)}")
+    order = 'ASC' if request.args.get('order', 'desc').lower() == 'asc' else 'DESC'
+    return page, per_page, sort, order
+
+def load_alumni_summary():
+    """Totals for the alumni analytics panel.
+
+    Count and average come from the running rollup, the year range from the
+    year indexes, so the cost doesn't grow with the number of alumni.
+    """
+    rollup = query_store('SELECT count, amount FROM stats_rollups WHERE metric = ? AND period = ? AND bucket = ?',
+                         ('alumni', 'all', ''))
+    total, years = (rollup[0]['count'], rollup[0]['amount']) if rollup else (0, 0)
+    return {
+        'total': total,
+        'earliest_start': query_store('SELECT MIN(year_started) AS year FROM alumni')[0]['year'],
+        'latest_finish': query_store('SELECT MAX(year_finished) AS year FROM alumni')[0]['year'],
+        'average_duration': years / total if total else None
+    }
+
+def load_stats():
+    """Get the dashboard totals from the running rollups"""
+    totals = {row['metric']: row for row in query_store(
+        "SELECT metric, count, amount FROM stats_rollups WHERE period = 'all'")}
+    
+    def count(metric):
+        return totals[metric]['count'] if metric in totals else 0
+    
+    return {
+        'total_amount': totals['donations_completed']['amount'] if 'donations_completed' in totals else 0,
+        'successful_count': count('donations_completed'),
+        'pending_count': count('donations_pending'),
+        'total_attempts': sum(row['count'] for metric, row in totals.items() if metric.startswith('donations_')),
+        'total_alumni': count('alumni')
+    }
+
+def load_stats_series(period, since):
+    """Get per-day or per-month rollups from the given bucket onwards, oldest first"""
+    series = {}
+    for row in query_store('''SELECT metric, bucket, count, amount FROM stats_rollups
+                              WHERE period = ? AND bucket >= ? ORDER BY bucket''', (period, since)):
+        if row['count'] == 0:
+            continue
+        entry = series.setdefault(row['bucket'], {'bucket': row['bucket']})
+        entry[f"{row['metric']}_count"] = row['count']
+        if row['metric'] == 'donations_completed':
+            entry['donations_completed_amount'] = row['amount']
+    return list(series.values())
 
 def is_admin_logged_in():
     """Check if admin is logged in"""
@@ -104,11 +950,100 @@ def validate_phone_number(phone):
     
     return None
 
-def get_mpesa_access_token():
-    """Get M-Pesa access token"""
+# Keep-alive connection pool shared by all Daraja calls
+mpesa_session = requests.Session()
+mpesa_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=16))
+mpesa_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=16))
+
+class MpesaUnavailable(Exception):
+    """Raised instead of calling Daraja while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Stops calling an upstream after repeated failures.
+
+    After `threshold` consecutive failures the breaker opens and calls fail
+    fast. Once `reset_after` seconds have passed a single trial call is let
+    through (half-open); its outcome closes or re-opens the breaker.
+    """
+
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0
+        self._set_state('closed')
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.set('mpesa_circuit_state', (), self.STATES[state])
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_after:
+                self._set_state('half_open')
+                return True
+            return False
+
+    def is_open(self):
+        with self._lock:
+            return self.state == 'open' and time.monotonic() - self._opened_at < self.reset_after
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != 'closed':
+                self._set_state('closed')
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or self._failures >= self.threshold:
+                if self.state != 'open':
+                    print(f"Daraja circuit breaker opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+                self._set_state('open')
+
+mpesa_breaker = CircuitBreaker(MPESA_BREAKER_THRESHOLD, MPESA_BREAKER_RESET)
+
+def mpesa_request(call, method, url, retries=0, **kwargs):
+    """Call Daraja through the circuit breaker with connect and read timeouts.
+
+    Only pass retries for idempotent calls. Connection errors, timeouts and
+    5xx responses count as failures and are retried after a jittered,
+    doubling backoff so recovering workers do not all hit Daraja at once.
+    """
+    for attempt in range(retries + 1):
+        if not mpesa_breaker.allow():
+            metrics.inc('mpesa_circuit_rejections_total', (('call', call),))
+            raise MpesaUnavailable(MPESA_UNAVAILABLE_MESSAGE)
+        try:
+            response = timed_mpesa_call(call, lambda: mpesa_session.request(
+                method, url, timeout=(MPESA_CONNECT_TIMEOUT, MPESA_READ_TIMEOUT), **kwargs))
+        except Exception:
+            mpesa_breaker.record_failure()
+            if attempt == retries:
+                raise
+        else:
+            if response.status_code < 500:
+                mpesa_breaker.record_success()
+                return response
+            mpesa_breaker.record_failure()
+            if attempt == retries:
+                return response
+        time.sleep(random.uniform(0, MPESA_RETRY_BACKOFF * 2 ** attempt))
+
+_mpesa_token = {'value': None, 'expires_at': 0}
+_mpesa_token_lock = threading.Lock()
+
+def fetch_mpesa_access_token():
+    """Request a new M-Pesa access token, returning (token, expires_in)"""
     try:
-        url = 'https://sandbox.safaricom.co.ke/mpesa/stkpushquery/v1/query'
-        # For production, use: https://api.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials
+        url = f'{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials'
         
         credentials = base64.b64encode(f"{MPESA_CONSUMER_KEY}:{MPESA_CONSUMER_SECRET}".encode()).decode()
         
@@ -117,17 +1052,44 @@ def get_mpesa_access_token():
             'Content-Type': 'application/json'
         }
         
-        response = requests.get(url, headers=headers)
+        response = mpesa_request('token', 'GET', url, retries=MPESA_TOKEN_RETRIES, headers=headers)
         if response.status_code == 200:
-            return response.json().get('access_token')
-        return None
+            data = response.json()
+            return data.get('access_token'), int(data.get('expires_in', 3599))
+        return None, 0
+    except MpesaUnavailable:
+        raise
     except Exception as e:
         print(f"Error getting access token: {e}")
-        return None
+        return None, 0
+
+def get_mpesa_access_token():
+    """Get M-Pesa access token, reusing the cached one until shortly before it expires"""
+    if _mpesa_token['value'] and time.time() < _mpesa_token['expires_at']:
+        return _mpesa_token['value']
+    
+    # Only one request refreshes the token, the others wait and reuse it
+    with _mpesa_token_lock:
+        if _mpesa_token['value'] and time.time() < _mpesa_token['expires_at']:
+            return _mpesa_token['value']
+        
+        token, expires_in = fetch_mpesa_access_token()
+        if token:
+            _mpesa_token['value'] = token
+            _mpesa_token['expires_at'] = time.time() + max(expires_in - MPESA_TOKEN_REFRESH_MARGIN, 0)
+        return token
+
+def clear_mpesa_access_token():
+    """Forget the cached token, e.g. after Daraja rejects it"""
+    _mpesa_token['value'] = None
+    _mpesa_token['expires_at'] = 0
 
 def initiate_mpesa_payment(phone, amount, account_ref, transaction_desc):
     """Initiate M-Pesa STK Push"""
-    access_token = get_mpesa_access_token()
+    try:
+        access_token = get_mpesa_access_token()
+    except MpesaUnavailable:
+        return {'success': False, 'message': MPESA_UNAVAILABLE_MESSAGE, 'retryable': False}
     if not access_token:
         return {'success': False, 'message': 'Failed to get access token'}
     
@@ -138,8 +1100,7 @@ def initiate_mpesa_payment(phone, amount, account_ref, transaction_desc):
     password_string = f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}"
     password = base64.b64encode(password_string.encode()).decode()
     
-    url = 'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
-    # For production, use: https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest
+    url = f'{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest'
     
     headers = {
         'Authorization': f'Bearer {access_token}',
@@ -162,20 +1123,134 @@ def initiate_mpesa_payment(phone, amount, account_ref, transaction_desc):
     }
     
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        # Not retried here: a push that timed out may still reach the phone
+        response = mpesa_request('stk_push', 'POST', url, json=payload, headers=headers)
+        if response.status_code == 401:
+            clear_mpesa_access_token()
         return response.json()
+    except MpesaUnavailable:
+        return {'success': False, 'message': MPESA_UNAVAILABLE_MESSAGE, 'retryable': False}
+    except requests.exceptions.ReadTimeout:
+        return {'success': False, 'message': 'M-Pesa did not respond in time', 'retryable': False,
+                'unconfirmed': True}
     except Exception as e:
         return {'success': False, 'message': f'Request failed: {str(e)}'}
 
+# Background STK push jobs
+STK_WORKERS = int(os.environ.get('STK_WORKERS', 4))
+STK_MAX_ATTEMPTS = int(os.environ.get('STK_MAX_ATTEMPTS', 3))
+STK_RETRY_BACKOFF = float(os.environ.get('STK_RETRY_BACKOFF', 2))  # seconds, doubled per attempt
+# How long a push whose request timed out can still be matched to its callback
+STK_UNCONFIRMED_WINDOW = int(os.environ.get('STK_UNCONFIRMED_WINDOW', 15))  # minutes
+STK_UNCONFIRMED_ERROR = 'M-Pesa did not confirm the payment request in time'
+
+stk_queue = queue.Queue()
+_stk_workers_started = False
+_stk_workers_lock = threading.Lock()
+
+def is_retryable_mpesa_error(mpesa_response):
+    """Only retry failures that happened before Daraja accepted or rejected the request"""
+    if not mpesa_response.get('retryable', True):
+        return False
+    return 'ResponseCode' not in mpesa_response and 'errorCode' not in mpesa_response
+
+def donation_status_message(status, error=None):
+    if status == 'completed':
+        return 'Thank you! Your contribution has been received.'
+    if status == 'failed':
+        return f"Payment failed: {error or 'Unknown error'}"
+    return 'Waiting for you to confirm the payment on your phone.'
+
+def notify_donation_status(reference, status, error=None):
+    """Push a donation status change to anyone watching that reference"""
+    socketio.emit('donation_status', {
+        'reference': reference,
+        'status': status,
+        'message': donation_status_message(status, error)
+    }, to=f'donation_{reference}')
+
+def process_stk_job(job):
+    """Send one STK push, retrying transient failures with backoff"""
+    for attempt in range(1, STK_MAX_ATTEMPTS + 1):
+        mpesa_response = initiate_mpesa_payment(
+            job['phone'],
+            job['amount'],
+            job['reference'],
+            f"School Support - {job['name']}"
+        )
+        if mpesa_response.get('ResponseCode') == '0':
+            # Remember which STK push belongs to this donation for the callback
+            update_donation(job['donation_id'],
+                            checkout_request_id=mpesa_response.get('CheckoutRequestID'),
+                            merchant_request_id=mpesa_response.get('MerchantRequestID'))
+            notify_donation_status(job['reference'], 'pending')
+            return
+        if mpesa_response.get('unconfirmed'):
+            # The push may still have reached the phone, so the donation stays
+            # pending until its callback is matched by phone and amount
+            update_donation(job['donation_id'], error=STK_UNCONFIRMED_ERROR)
+            notify_donation_status(job['reference'], 'pending')
+            return
+        if attempt == STK_MAX_ATTEMPTS or not is_retryable_mpesa_error(mpesa_response):
+            break
+        time.sleep(STK_RETRY_BACKOFF * 2 ** (attempt - 1) + random.uniform(0, 1))
+    
+    error = mpesa_response.get('errorMessage') or mpesa_response.get('message', 'Unknown error')
+    update_donation(job['donation_id'], status='failed', error=error)
+    notify_donation_status(job['reference'], 'failed', error)
+
+def stk_worker():
+    while True:
+        job = stk_queue.get()
+        try:
+            with app.app_context():
+                process_stk_job(job)
+        except Exception as e:
+            print(f"STK job error for {job.get('reference')}: {e}")
+        finally:
+            stk_queue.task_done()
+
+def enqueue_stk_push(job):
+    """Queue an STK push, starting the worker pool on first use"""
+    global _stk_workers_started
+    if not _stk_workers_started:
+        with _stk_workers_lock:
+            if not _stk_workers_started:
+                # Green threads once eventlet has monkey-patched threading
+                for _ in range(STK_WORKERS):
+                    threading.Thread(target=stk_worker, daemon=True).start()
+                _stk_workers_started = True
+    stk_queue.put(job)
+
 # Routes
+_index_page = {}
+
+def invalidate_index_page():
+    _index_page.clear()
+
+def get_index_page():
+    """Render the main page once per announcements version"""
+    version = store_version('announcements')
+    if _index_page.get('version') != version:
+        body = render_template('index.html', announcements=load_announcements()).encode()
+        _index_page.update({
+            'version': version,
+            'body': body,
+            'etag': hashlib.sha256(body).hexdigest()[:32],
+            'last_modified': datetime.now(timezone.utc).replace(microsecond=0)
+        })
+    return _index_page
+
 @app.route('/', methods=['GET', 'HEAD'])
 def index():
     """Display the main page with announcements"""
-
-    if request.method == 'HEAD':
-        return '', 200
-    announcements = load_announcements()
-    return render_template('index.html', announcements=announcements)
+    page = get_index_page()
+    response = Response(page['body'], mimetype='text/html')
+    response.set_etag(page['etag'])
+    response.last_modified = page['last_modified']
+    # Let browsers and crawlers keep a copy but revalidate it every time
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/support', methods=['GET', 'POST'])
 def support():
@@ -205,13 +1280,15 @@ def support():
         except (ValueError, TypeError):
             return jsonify({'success': False, 'message': 'Invalid amount'})
         
-        # Generate unique reference
-        reference = f"SCH{datetime.now().strftime('%Y%m%d%H%M%S')}{secrets.randbelow(1000):03d}"
+        # Fail fast instead of queueing pushes while Daraja is down
+        if mpesa_breaker.is_open():
+            return jsonify({'success': False, 'message': MPESA_UNAVAILABLE_MESSAGE})
+        
+        # Generate unique reference; 32 random bits per second keeps the UNIQUE column collision-free
+        reference = f"SCH{datetime.now().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(4).upper()}"
         
         # Save donation record (pending)
-        donations = load_donations()
-        donation_record = {
-            'id': len(donations) + 1,
+        donation_id = add_donation({
             'reference': reference,
             'name': name,
             'phone': validated_phone,
@@ -219,37 +1296,39 @@ def support():
             'status': 'pending',
             'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'mpesa_receipt': None
-        }
-        donations.append(donation_record)
-        save_donations(donations)
+        })
         
-        # Initiate M-Pesa payment
-        mpesa_response = initiate_mpesa_payment(
-            validated_phone,
-            amount,
-            reference,
-            f"School Support - {name}"
-        )
+        # Initiate M-Pesa payment in the background
+        enqueue_stk_push({
+            'donation_id': donation_id,
+            'reference': reference,
+            'name': name,
+            'phone': validated_phone,
+            'amount': amount
+        })
         
-        if mpesa_response.get('ResponseCode') == '0':
-            return jsonify({
-                'success': True,
-                'message': 'Payment request sent to your phone. Please complete the transaction.',
-                'checkout_request_id': mpesa_response.get('CheckoutRequestID')
-            })
-        else:
-            # Update donation status to failed
-            donation_record['status'] = 'failed'
-            donation_record['error'] = mpesa_response.get('errorMessage', 'Unknown error')
-            save_donations(donations)
-            
-            return jsonify({
-                'success': False,
-                'message': f"Payment initiation failed: {mpesa_response.get('errorMessage', 'Unknown error')}"
-            })
+        return jsonify({
+            'success': True,
+            'message': 'Payment request is being sent to your phone. Please complete the transaction.',
+            'reference': reference
+        })
     
     return render_template('support.html')
 
+@app.route('/support/status/<reference>', methods=['GET'])
+def donation_status(reference):
+    """Lightweight status check for a donation the browser started"""
+    donation = query_store('SELECT status, error FROM donations WHERE reference = ?', (reference,))
+    if not donation:
+        return jsonify({'error': 'Donation not found'}), 404
+    
+    status = donation[0]['status']
+    return jsonify({
+        'reference': reference,
+        'status': status,
+        'message': donation_status_message(status, donation[0]['error'])
+    })
+
 @app.route('/mpesa/callback', methods=['POST'])
 def mpesa_callback():
     """Handle M-Pesa callback"""
@@ -257,44 +1336,35 @@ def mpesa_callback():
         callback_data = request.get_json()
         
         # Extract relevant information
-        result_code = callback_data.get('Body', {}).get('stkCallback', {}).get('ResultCode')
-        checkout_request_id = callback_data.get('Body', {}).get('stkCallback', {}).get('CheckoutRequestID')
+        stk_callback = callback_data.get('Body', {}).get('stkCallback', {})
+        result_code = stk_callback.get('ResultCode')
+        checkout_request_id = stk_callback.get('CheckoutRequestID')
+        
+        if not checkout_request_id:
+            return jsonify({'ResultCode': 1, 'ResultDesc': 'Missing CheckoutRequestID'})
         
         if result_code == 0:  # Success
             # Extract transaction details
-            callback_metadata = callback_data.get('Body', {}).get('stkCallback', {}).get('CallbackMetadata', {}).get('Item', [])
-            
-            amount = None
-            mpesa_receipt = None
-            phone = None
+            callback_metadata = stk_callback.get('CallbackMetadata', {}).get('Item', [])
             
-            for item in callback_metadata:
-                if item.get('Name') == 'Amount':
-                    amount = item.get('Value')
-                elif item.get('Name') == 'MpesaReceiptNumber':
-                    mpesa_receipt = item.get('Value')
-                elif item.get('Name') == 'PhoneNumber':
-                    phone = item.get('Value')
+            metadata = {item.get('Name'): item.get('Value') for item in callback_metadata}
             
             # Update donation status
-            donations = load_donations()
-            for donation in donations:
-                if donation['phone'] == str(phone) and donation['amount'] == amount and donation['status'] == 'pending':
-                    donation['status'] = 'completed'
-                    donation['mpesa_receipt'] = mpesa_receipt
-                    donation['completed_date'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    break
-            
-            save_donations(donations)
+            status = 'completed'
+            error = None
+            reference = settle_donation(checkout_request_id, phone=metadata.get('PhoneNumber'),
+                                        amount=metadata.get('Amount'), status=status,
+                                        mpesa_receipt=metadata.get('MpesaReceiptNumber'),
+                                        completed_date=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
         else:
             # Payment failed - update status
-            donations = load_donations()
-            for donation in donations:
-                if donation['status'] == 'pending':  # This is a simple matching - you might want to improve this
-                    donation['status'] = 'failed'
-                    donation['error'] = 'Payment was cancelled or failed'
-                    break
-            save_donations(donations)
+            status = 'failed'
+            error = stk_callback.get('ResultDesc') or 'Payment was cancelled or failed'
+            reference = settle_donation(checkout_request_id, status=status, error=error)
+        
+        # Already settled (duplicate callback) or not one of ours
+        if reference:
+            notify_donation_status(reference, status, error)
         
         return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'})
     
@@ -303,10 +1373,118 @@ def mpesa_callback():
         return jsonify({'ResultCode': 1, 'ResultDesc': 'Failed'})
 
 # Database setup
-def init_db():
-    conn = sqlite3.connect('teachers_portal.db')
-    c = conn.cursor()
-    
+DATABASE = 'teachers_portal.db'
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+_db_pool = []
+_db_pool_lock = threading.Lock()
+
+# Statements slower than this are logged with their query plan. 0 logs the plan
+# of every distinct statement once, e.g. to check index use under loadtest.py
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+_explained_queries = set()
+
+def explain_query(conn, sql, params=()):
+    """EXPLAIN QUERY PLAN lines for a statement, table scans flagged"""
+    plan = sqlite3.Cursor(conn).execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+    lines = []
+    for row in plan:
+        detail = row[-1]
+        if detail.startswith('SCAN') and 'INDEX' not in detail:
+            detail += '  <-- table scan'
+        lines.append(detail)
+    return lines
+
+def log_slow_query(conn, sql, params, seconds):
+    """Print a slow statement, with its query plan the first time it is seen"""
+    metrics.inc('sqlite_slow_queries_total')
+    statement = ' '.join(sql.split())
+    print(f"Slow query ({seconds * 1000:.1f} ms): {statement}")
+    if statement in _explained_queries or not re.match(r'(SELECT|INSERT|UPDATE|DELETE|WITH)\b', statement, re.I):
+        return
+    _explained_queries.add(statement)
+    try:
+        for line in explain_query(conn, sql, params if params is not None else ()):
+            print(f"    {line}")
+    except sqlite3.Error as e:
+        # e.g. executemany, where there is no single set of parameters
+        print(f"    (no query plan: {e})")
+
+class MeteredCursor(sqlite3.Cursor):
+    """Cursor that reports each statement and its execution time to the metrics"""
+
+    def _timed(self, run, sql, params):
+        started = time.perf_counter()
+        try:
+            return run()
+        finally:
+            seconds = time.perf_counter() - started
+            record_db_query(seconds)
+            if seconds * 1000 >= SLOW_QUERY_MS:
+                log_slow_query(self.connection, sql, params, seconds)
+
+    def execute(self, sql, params=()):
+        return self._timed(lambda: sqlite3.Cursor.execute(self, sql, params), sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._timed(lambda: sqlite3.Cursor.executemany(self, sql, seq_of_params), sql, None)
+
+    def executescript(self, script):
+        return self._timed(lambda: sqlite3.Cursor.executescript(self, script), script, None)
+
+class MeteredConnection(sqlite3.Connection):
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+def connect_db():
+    """Open a tuned connection to the teachers portal database.
+
+    WAL lets readers carry on while a write is in progress, and busy_timeout
+    makes bursts of writers wait for the lock instead of failing with
+    "database is locked".
+    """
+    conn = sqlite3.connect(DATABASE, timeout=DB_BUSY_TIMEOUT_MS / 1000, factory=MeteredConnection,
+                           check_same_thread=False, cached_statements=256)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA cache_size = -8000')  # ~8 MB page cache
+    conn.execute('PRAGMA mmap_size = 67108864')  # 64 MB
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+    return conn
+
+def get_db():
+    """Get the connection for the current request (or greenlet).
+
+    The connection is checked out of a small pool the first time it is needed
+    and returned by close_db when the app context ends, so every helper used
+    while handling a request shares it.
+    """
+    if '_db' not in g:
+        with _db_pool_lock:
+            conn = _db_pool.pop() if _db_pool else None
+        g._db = conn or connect_db()
+    return g._db
+
+@app.teardown_appcontext
+def close_db(exception=None):
+    """Return the request's connection to the pool"""
+    conn = g.pop('_db', None)
+    if conn is None:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    with _db_pool_lock:
+        if len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append(conn)
+            return
+    conn.close()
+
+def create_portal_tables(c):
+    """Create the teachers portal and chat tables"""
     # Teachers table
     c.execute('''CREATE TABLE IF NOT EXISTS teachers (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -360,6 +1538,97 @@ def init_db():
         FOREIGN KEY (teacher_id) REFERENCES teachers (id),
         UNIQUE(message_id, teacher_id, reaction)
     )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)')
+    
+    # Cold storage for old messages and their reactions (see archive_messages)
+    c.execute('''CREATE TABLE IF NOT EXISTS messages_archive (
+        id INTEGER PRIMARY KEY,
+        sender_id INTEGER,
+        content TEXT NOT NULL,
+        reply_to INTEGER,
+        created_at TIMESTAMP
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS reactions_archive (
+        id INTEGER PRIMARY KEY,
+        message_id INTEGER,
+        teacher_id INTEGER,
+        reaction TEXT NOT NULL,
+        created_at TIMESTAMP
+    )''')
+    c.execute('''CREATE VIEW IF NOT EXISTS all_messages AS
+                 SELECT id, sender_id, content, reply_to, created_at FROM messages
+                 UNION ALL
+                 SELECT id, sender_id, content, reply_to, created_at FROM messages_archive''')
+    # Holds a row only inside an archiving transaction, so the triggers below
+    # can tell rows being moved to the archive from rows being deleted
+    c.execute('CREATE TABLE IF NOT EXISTS chat_archiving (active INTEGER)')
+    
+    # Reaction counts per message, kept current by triggers on reactions
+    c.execute('''CREATE TABLE IF NOT EXISTS message_reaction_counts (
+        message_id INTEGER NOT NULL,
+        reaction TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (message_id, reaction)
+    ) WITHOUT ROWID''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS reactions_insert_count AFTER INSERT ON reactions
+                 BEGIN
+                     INSERT INTO message_reaction_counts (message_id, reaction, count)
+                     VALUES (NEW.message_id, NEW.reaction, 1)
+                     ON CONFLICT (message_id, reaction) DO UPDATE SET count = count + 1;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS reactions_delete_count AFTER DELETE ON reactions
+                 WHEN NOT EXISTS (SELECT 1 FROM chat_archiving)
+                 BEGIN
+                     UPDATE message_reaction_counts SET count = count - 1
+                     WHERE message_id = OLD.message_id AND reaction = OLD.reaction;
+                     DELETE FROM message_reaction_counts
+                     WHERE message_id = OLD.message_id AND reaction = OLD.reaction AND count <= 0;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS messages_delete_counts AFTER DELETE ON messages
+                 WHEN NOT EXISTS (SELECT 1 FROM chat_archiving)
+                 BEGIN
+                     DELETE FROM message_reaction_counts WHERE message_id = OLD.id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS messages_archive_delete_counts AFTER DELETE ON messages_archive
+                 BEGIN
+                     DELETE FROM message_reaction_counts WHERE message_id = OLD.id;
+                 END''')
+    
+    # Full-text index over hot and archived message content, mirrored by triggers
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content,
+        content = 'all_messages',
+        content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2'
+    )''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS messages_insert_fts AFTER INSERT ON messages
+                 BEGIN
+                     INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS messages_delete_fts AFTER DELETE ON messages
+                 WHEN NOT EXISTS (SELECT 1 FROM chat_archiving)
+                 BEGIN
+                     INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS messages_archive_delete_fts AFTER DELETE ON messages_archive
+                 BEGIN
+                     INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS messages_update_fts AFTER UPDATE OF content ON messages
+                 BEGIN
+                     INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+                     INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+                 END''')
+
+def rebuild_message_search(c):
+    """Re-index every message in the full-text search table"""
+    c.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def init_db():
+    conn = connect_db()
+    c = conn.cursor()
+    
+    create_portal_tables(c)
     
     # Insert some sample registration codes (remove in production)
     c.execute('''INSERT OR IGNORE INTO registration_codes (code, created_by) VALUES 
@@ -372,12 +1641,411 @@ def init_db():
                  ('%@bishopabiero.ac.ke', 'admin'),
                  ('%@bishopabiero.edu', 'admin')''')
 
-    # Add this to create the missing column
-    # c.execute('ALTER TABLE teachers ADD COLUMN registration_code TEXT')
+    conn.commit()
+    run_migrations(conn)
+    conn.close()
 
-    
+def add_missing_columns(c, table, columns):
+    """Add columns that an older copy of a table doesn't have yet"""
+    c.execute(f'PRAGMA table_info({table})')
+    existing = {row[1] for row in c.fetchall()}
+    for column, definition in columns.items():
+        if column not in existing:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+STATS_PERIODS = {
+    'all': "''",
+    'day': "coalesce(substr({date}, 1, 10), '')",
+    'month': "coalesce(substr({date}, 1, 7), '')",
+}
+
+def rollup_statements(metric, amount, date, sign):
+    """SQL that adds (sign=1) or removes (sign=-1) one record from every rollup bucket"""
+    return ' '.join(f'''INSERT INTO stats_rollups (metric, period, bucket, count, amount)
+                        VALUES ({metric}, '{period}', {bucket.format(date=date)}, {sign}, {sign} * ({amount}))
+                        ON CONFLICT (metric, period, bucket)
+                        DO UPDATE SET count = count + excluded.count, amount = amount + excluded.amount;'''
+                    for period, bucket in STATS_PERIODS.items())
+
+# Table -> (metric, amount, date, update event) expressions for its rollups.
+# An alumni rollup's amount is the summed years of study, for the average.
+ROLLUP_SOURCES = {
+    'donations': ("'donations_' || {row}.status", '{row}.amount', '{row}.date', 'UPDATE OF status, amount, date'),
+    'alumni': ("'alumni'", '{row}.year_finished - {row}.year_started', '{row}.submitted_at',
+               'UPDATE OF submitted_at, year_started, year_finished'),
+}
+
+def create_rollup_triggers(c):
+    """Keep stats_rollups current as donations and alumni change"""
+    for table, (metric, amount, date, update_event) in ROLLUP_SOURCES.items():
+        def rollup(row, sign):
+            return rollup_statements(metric.format(row=row), amount.format(row=row),
+                                     date.format(row=row), sign)
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_insert_rollup AFTER INSERT ON {table}
+                      BEGIN {rollup('NEW', 1)} END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_update_rollup AFTER {update_event} ON {table}
+                      BEGIN {rollup('OLD', -1)} {rollup('NEW', 1)} END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_delete_rollup AFTER DELETE ON {table}
+                      BEGIN {rollup('OLD', -1)} END''')
+
+def rebuild_stats(c):
+    """Recompute every rollup from the donations and alumni tables"""
+    c.execute('DELETE FROM stats_rollups')
+    for period, bucket in STATS_PERIODS.items():
+        c.execute(f'''INSERT INTO stats_rollups (metric, period, bucket, count, amount)
+                      SELECT 'donations_' || status, '{period}', {bucket.format(date='date')}, COUNT(*), SUM(amount)
+                      FROM donations GROUP BY 1, 3''')
+        c.execute(f'''INSERT INTO stats_rollups (metric, period, bucket, count, amount)
+                      SELECT 'alumni', '{period}', {bucket.format(date='submitted_at')}, COUNT(*),
+                             SUM(year_finished - year_started)
+                      FROM alumni GROUP BY 3''')
+
+def init_stores():
+    """Create the announcement, donation and alumni tables"""
+    conn = connect_db()
+    c = conn.cursor()
+
+    create_portal_tables(c)
+
+    c.execute('''CREATE TABLE IF NOT EXISTS announcements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        date TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS donations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reference TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        amount REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        date TEXT,
+        mpesa_receipt TEXT,
+        error TEXT,
+        completed_date TEXT
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS alumni (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        year_started INTEGER NOT NULL,
+        year_finished INTEGER NOT NULL,
+        submitted_at TEXT
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_alumni_year_finished ON alumni (year_finished)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_alumni_year_started ON alumni (year_started)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_donations_date ON donations (date)')
+
+    # Write counters used to validate the in-memory store cache
+    c.execute('''CREATE TABLE IF NOT EXISTS store_versions (
+        store TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )''')
+    for table in ('announcements', 'donations', 'alumni'):
+        c.execute('INSERT OR IGNORE INTO store_versions (store) VALUES (?)', (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version
+                          AFTER {event} ON {table}
+                          BEGIN
+                              UPDATE store_versions SET version = version + 1 WHERE store = '{table}';
+                          END''')
+
+    # Running totals for the admin dashboard, overall and per day/month
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_rollups (
+        metric TEXT NOT NULL,
+        period TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        amount REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (metric, period, bucket)
+    )''')
+    create_rollup_triggers(c)
+
+    # Which legacy JSON files have already been imported
+    c.execute('''CREATE TABLE IF NOT EXISTS json_imports (
+        filename TEXT PRIMARY KEY,
+        records INTEGER,
+        imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    conn.commit()
+    run_migrations(conn)
+    conn.close()
+
+# Schema migrations, applied once per database in version order
+MIGRATIONS = []
+
+def migration(version, name):
+    """Register a schema change; run_migrations applies it and records the version"""
+    def decorator(f):
+        MIGRATIONS.append((version, name, f))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return f
+    return decorator
+
+@migration(1, 'teachers.registration_code column')
+def migrate_teacher_registration_code(c):
+    add_missing_columns(c, 'teachers', {'registration_code': 'TEXT'})
+
+@migration(2, 'indexes for chat history and teacher approval')
+def migrate_chat_indexes(c):
+    # reactions.message_id is already the leading column of the
+    # UNIQUE(message_id, teacher_id, reaction) index, and messages.created_at
+    # is indexed with the archive tables, so neither needs another index
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_teachers_is_approved ON teachers (is_approved)')
+
+@migration(3, 'donations.checkout_request_id and merchant_request_id columns')
+def migrate_donation_checkout_ids(c):
+    add_missing_columns(c, 'donations', {
+        'checkout_request_id': 'TEXT',
+        'merchant_request_id': 'TEXT'
+    })
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_donations_checkout_request
+                 ON donations (checkout_request_id)''')
+
+@migration(4, 'search index over hot and archived messages')
+def migrate_archive_search(c):
+    # Older databases index messages only, and their delete triggers would
+    # drop reaction counts and index entries when messages are archived
+    for trigger in ('reactions_delete_count', 'messages_delete_counts', 'messages_delete_fts'):
+        c.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    c.execute('DROP TABLE IF EXISTS messages_fts')
+    create_portal_tables(c)
+    rebuild_message_search(c)
+
+@migration(5, 'backfill message_reaction_counts')
+def migrate_reaction_counts(c):
+    c.execute('DELETE FROM message_reaction_counts')
+    c.execute('''INSERT INTO message_reaction_counts (message_id, reaction, count)
+                 SELECT message_id, reaction, COUNT(*) FROM (
+                     SELECT message_id, reaction FROM reactions
+                     UNION ALL
+                     SELECT message_id, reaction FROM reactions_archive
+                 ) GROUP BY message_id, reaction''')
+
+@migration(6, 'backfill stats_rollups')
+def migrate_stats_rollups(c):
+    rebuild_stats(c)
+
+@migration(7, 'donations (status, date) index for the admin filter and sort')
+def migrate_donation_status_index(c):
+    # (status, phone, amount) served the callback's phone/amount match, which
+    # now goes through checkout_request_id
+    c.execute('DROP INDEX IF EXISTS idx_donations_status_phone')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_donations_status_date ON donations (status, date)')
+
+@migration(8, 'one archived reaction per teacher, counted down on delete')
+def migrate_reactions_archive_unique(c):
+    # Re-reacting to an archived message used to add a second row instead of
+    # toggling the archived one off; keep the first and recount
+    c.execute('''DELETE FROM reactions_archive WHERE id NOT IN (
+                     SELECT MIN(id) FROM reactions_archive GROUP BY message_id, teacher_id, reaction)''')
+    c.execute('''DELETE FROM reactions WHERE EXISTS (
+                     SELECT 1 FROM reactions_archive a WHERE a.message_id = reactions.message_id
+                     AND a.teacher_id = reactions.teacher_id AND a.reaction = reactions.reaction)''')
+    c.execute('DROP INDEX IF EXISTS idx_reactions_archive_message')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_reactions_archive_unique
+                 ON reactions_archive (message_id, teacher_id, reaction)''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS reactions_archive_delete_count AFTER DELETE ON reactions_archive
+                 WHEN NOT EXISTS (SELECT 1 FROM chat_archiving)
+                 BEGIN
+                     UPDATE message_reaction_counts SET count = count - 1
+                     WHERE message_id = OLD.message_id AND reaction = OLD.reaction;
+                     DELETE FROM message_reaction_counts
+                     WHERE message_id = OLD.message_id AND reaction = OLD.reaction AND count <= 0;
+                 END''')
+    migrate_reaction_counts(c)
+
+@migration(9, 'stats_rollups (period, bucket) index for the dashboard reads')
+def migrate_stats_rollups_index(c):
+    # The primary key leads with metric, but the dashboard reads by period
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stats_rollups_period_bucket ON stats_rollups (period, bucket)')
+
+@migration(10, 'alumni rollups sum years of study')
+def migrate_alumni_rollup_duration(c):
+    for event in ('insert', 'update', 'delete'):
+        c.execute(f'DROP TRIGGER IF EXISTS alumni_{event}_rollup')
+    create_rollup_triggers(c)
+    rebuild_stats(c)
+
+@migration(11, 'index for matching unconfirmed STK pushes by phone and amount')
+def migrate_unconfirmed_donations_index(c):
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_donations_unconfirmed ON donations (phone, amount)
+                 WHERE status = 'pending' AND checkout_request_id IS NULL''')
+
+def run_migrations(conn):
+    """Apply every migration this database hasn't recorded yet.
+
+    Each one runs in its own IMMEDIATE transaction together with its
+    schema_migrations row, so concurrent workers apply it exactly once.
+    """
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    conn.commit()
+    for version, name, migrate in MIGRATIONS:
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('SELECT 1 FROM schema_migrations WHERE version = ?', (version,))
+        if c.fetchone():
+            conn.rollback()
+            continue
+        try:
+            migrate(c)
+            c.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (version, name))
+            conn.commit()
+            print(f"Applied migration {version}: {name}")
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"Error applying migration {version} ({name}): {e}")
+            raise
+
+@app.cli.command('migrations')
+def migrations_command():
+    """List schema migrations and when they were applied."""
+    conn = connect_db()
+    applied = dict(conn.execute('SELECT version, applied_at FROM schema_migrations').fetchall())
+    conn.close()
+    for version, name, _ in MIGRATIONS:
+        print(f"{version:>4}  {applied.get(version, 'pending'):<20}  {name}")
+
+init_stores()
+
+def import_json_stores():
+    """Copy the legacy announcements/donations/alumni JSON files into the database.
+
+    Each file is imported once; re-running is a no-op. Donation and alumni ids
+    are kept unless a row written since the tables were created already uses
+    them, in which case the legacy row gets a fresh id. Announcements always
+    get fresh ids because the old file has duplicates. Returns
+    {filename: (inserted, remapped)}.
+    """
+    conn = connect_db()
+    c = conn.cursor()
+    imported = {}
+    stores = [
+        (ANNOUNCEMENTS_FILE, 'announcements', ['title', 'content', 'date'], False),
+        (DONATIONS_FILE, 'donations', ['id', 'reference', 'name', 'phone', 'amount', 'status',
+                                       'date', 'mpesa_receipt', 'error', 'completed_date'], True),
+        (ALUMNI_DATA_FILE, 'alumni', ['id', 'name', 'phone', 'year_started', 'year_finished',
+                                      'submitted_at'], True),
+    ]
+    try:
+        for filename, table, columns, keep_ids in stores:
+            c.execute('SELECT 1 FROM json_imports WHERE filename = ?', (filename,))
+            if c.fetchone():
+                continue
+            records = load_data(filename)
+            # Announcements were stored newest first
+            if not keep_ids:
+                records = list(reversed(records))
+            rows, remapped, seen_ids = [], [], set()
+            for record in records:
+                row = {column: record.get(column) for column in columns}
+                if keep_ids:
+                    c.execute(f'SELECT 1 FROM {table} WHERE id = ?', (row['id'],))
+                    if c.fetchone() or row['id'] in seen_ids:
+                        # Inserted last, so the fresh id cannot take another legacy row's id
+                        del row['id']
+                        remapped.append(row)
+                        continue
+                    seen_ids.add(row['id'])
+                rows.append(row)
+            inserted = 0
+            for row in rows + remapped:
+                c.execute(f"INSERT INTO {table} ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                          tuple(row.values()))
+                inserted += c.rowcount
+            c.execute('INSERT INTO json_imports (filename, records) VALUES (?, ?)', (filename, inserted))
+            imported[filename] = (inserted, len(remapped))
+        conn.commit()
+    finally:
+        # Closing without a commit rolls back a half-done import
+        conn.close()
+    return imported
+
+@app.cli.command('import-json')
+def import_json_command():
+    """Import the legacy JSON data files into the database."""
+    try:
+        imported = import_json_stores()
+    except sqlite3.IntegrityError as e:
+        # Nothing was committed, so the import can be re-run once the data is fixed
+        raise click.ClickException(f'Import failed, no records were imported: {e}')
+    if not imported:
+        print('Nothing to import')
+    for filename, (count, remapped) in imported.items():
+        print(f'Imported {count} records from {filename}' + (f' ({remapped} given new ids)' if remapped else ''))
+
+CHAT_ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', 180))
+CHAT_ARCHIVE_BATCH_SIZE = int(os.environ.get('CHAT_ARCHIVE_BATCH_SIZE', 500))
+
+def archive_messages(days=CHAT_ARCHIVE_AFTER_DAYS, batch_size=CHAT_ARCHIVE_BATCH_SIZE, pause=0.05):
+    """Move messages older than `days` and their reactions into the archive tables.
+
+    Works in small transactions with a short pause in between, so chat writes
+    are never held up for long. Reaction counts and the search index are kept
+    for archived messages. Returns the number of messages moved.
+    """
+    # created_at is stored by SQLite's CURRENT_TIMESTAMP, which is UTC
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    conn = connect_db()
+    c = conn.cursor()
+    moved = 0
+    try:
+        while True:
+            c.execute('BEGIN IMMEDIATE')
+            c.execute('INSERT INTO chat_archiving (active) VALUES (1)')
+            c.execute('SELECT id FROM messages WHERE created_at < ? ORDER BY created_at LIMIT ?',
+                      (cutoff, batch_size))
+            ids = [row[0] for row in c.fetchall()]
+            if ids:
+                placeholders = ','.join('?' * len(ids))
+                c.execute(f'''INSERT OR REPLACE INTO messages_archive (id, sender_id, content, reply_to, created_at)
+                              SELECT id, sender_id, content, reply_to, created_at FROM messages
+                              WHERE id IN ({placeholders})''', ids)
+                # Also sweep up reactions added to messages archived earlier
+                c.execute(f'''INSERT OR REPLACE INTO reactions_archive (id, message_id, teacher_id, reaction, created_at)
+                              SELECT id, message_id, teacher_id, reaction, created_at FROM reactions
+                              WHERE message_id IN ({placeholders})
+                                 OR message_id IN (SELECT id FROM messages_archive)''', ids)
+                c.execute(f'''DELETE FROM reactions WHERE message_id IN ({placeholders})
+                                 OR message_id IN (SELECT id FROM messages_archive)''', ids)
+                c.execute(f'DELETE FROM messages WHERE id IN ({placeholders})', ids)
+            c.execute('DELETE FROM chat_archiving')
+            conn.commit()
+            moved += len(ids)
+            if len(ids) < batch_size:
+                return moved
+            time.sleep(pause)
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+
+@app.cli.command('archive-messages')
+@click.option('--days', default=CHAT_ARCHIVE_AFTER_DAYS, show_default=True,
+              help='Archive messages older than this many days.')
+def archive_messages_command(days):
+    """Move old chat messages and reactions into the archive tables."""
+    print(f'Archived {archive_messages(days)} messages')
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Backfill the chat full-text search index from hot and archived messages."""
+    conn = connect_db()
+    rebuild_message_search(conn.cursor())
     conn.commit()
+    count = conn.execute('SELECT COUNT(*) FROM all_messages').fetchone()[0]
     conn.close()
+    print(f'Indexed {count} messages')
 
 # Helper functions for validation
 def is_valid_school_email(email):
@@ -387,32 +2055,29 @@ def is_valid_school_email(email):
 
 def is_pre_approved_email(email):
     """Check if email is in pre-approved list"""
-    conn = sqlite3.connect('teachers_portal.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT COUNT(*) FROM approved_emails WHERE email = ? OR ? LIKE email', 
               (email.lower(), email.lower()))
     result = c.fetchone()[0] > 0
-    conn.close()
     return result
 
 def validate_registration_code(code):
     """Check if registration code is valid and unused"""
-    conn = sqlite3.connect('teachers_portal.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id FROM registration_codes WHERE code = ? AND is_used = 0', (code,))
     result = c.fetchone()
-    conn.close()
     return result is not None
 
 def use_registration_code(code, teacher_id):
     """Mark registration code as used"""
-    conn = sqlite3.connect('teachers_portal.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('''UPDATE registration_codes 
                  SET is_used = 1, used_by = ?, used_at = CURRENT_TIMESTAMP 
                  WHERE code = ?''', (teacher_id, code))
     conn.commit()
-    conn.close()
 
 # Authentication decorator
 def login_required(f):
@@ -423,6 +2088,29 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+APPROVAL_CACHE_TTL = int(os.environ.get('APPROVAL_CACHE_TTL', 60))  # seconds
+_approval_cache = {}
+
+def is_teacher_approved(teacher_id):
+    """Check a teacher's approval, cached for APPROVAL_CACHE_TTL seconds.
+
+    approve_teacher/reject_teacher invalidate the entry in this process, the
+    TTL bounds how long other workers can lag behind.
+    """
+    cached = _approval_cache.get(teacher_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    
+    c = get_db().cursor()
+    c.execute('SELECT is_approved FROM teachers WHERE id = ?', (teacher_id,))
+    result = c.fetchone()
+    approved = bool(result and result[0])
+    _approval_cache[teacher_id] = (approved, time.monotonic() + APPROVAL_CACHE_TTL)
+    return approved
+
+def invalidate_teacher_approval(teacher_id):
+    _approval_cache.pop(teacher_id, None)
+
 def approved_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -430,13 +2118,7 @@ def approved_required(f):
             return redirect(url_for('login'))
         
         # Check if teacher is approved
-        conn = sqlite3.connect('teachers_portal.db')
-        c = conn.cursor()
-        c.execute('SELECT is_approved FROM teachers WHERE id = ?', (session['teacher_id'],))
-        result = c.fetchone()
-        conn.close()
-        
-        if not result or not result[0]:
+        if not is_teacher_approved(session['teacher_id']):
             return render_template('pending_approval.html')
         
         return f(*args, **kwargs)
@@ -449,14 +2131,14 @@ def login():
         email = request.form['email']
         password = request.form['password']
         
-        conn = sqlite3.connect('teachers_portal.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute('SELECT id, first_name, is_approved FROM teachers WHERE email = ? AND password = ?', 
                  (email, password))
         teacher = c.fetchone()
-        conn.close()
         
         if teacher:
+            _approval_cache[teacher[0]] = (bool(teacher[2]), time.monotonic() + APPROVAL_CACHE_TTL)
             if teacher[2]:  # is_approved
                 session['teacher_id'] = teacher[0]
                 session['teacher_name'] = teacher[1]
@@ -495,7 +2177,7 @@ def register():
         if errors:
             return render_template('register.html', errors=errors)
         
-        conn = sqlite3.connect('teachers_portal.db')
+        conn = get_db()
         c = conn.cursor()
         try:
             # Determine approval status
@@ -518,9 +2200,8 @@ def register():
                 return render_template('registration_success.html', message='Registration successful! Please wait for admin approval.')
                 
         except sqlite3.IntegrityError:
+            conn.rollback()
             return render_template('register.html', errors=['Email already exists'])
-        finally:
-            conn.close()
     
     return render_template('register.html')
 
@@ -528,20 +2209,7 @@ def register():
 @login_required
 @approved_required
 def chat():
-    if 'teacher_id' not in session:
-        return redirect(url_for('login'))
-    
-    conn = sqlite3.connect('teachers_portal.db')
-    c = conn.cursor()
-    
-    # Check if teacher is approved
-    c.execute('SELECT is_approved FROM teachers WHERE id = ?', (session['teacher_id'],))
-    teacher = c.fetchone()
-    
-    if not teacher or not teacher[0]:
-        return render_template('pending_approval.html')  # Create this template
-    
-    conn.close()
+    # Login and approval are checked by the decorators
     # return render_template('chat.html')
     return render_template('chat.html', teacher_name=session['teacher_name'])
 
@@ -552,7 +2220,7 @@ def admin_panel():
     if session.get('teacher_name') != 'Admin':  # Replace with proper admin check
         return redirect(url_for('chat'))
     
-    conn = sqlite3.connect('teachers_portal.db')
+    conn = get_db()
     c = conn.cursor()
     
     # Get pending approvals
@@ -570,8 +2238,6 @@ def admin_panel():
                  FROM teachers WHERE is_approved = 1''')
     approved_teachers = c.fetchall()
     
-    conn.close()
-    
     return render_template('admin.html', 
                          pending_teachers=pending_teachers, 
                          unused_codes=unused_codes)
@@ -582,24 +2248,24 @@ def approve_teacher(teacher_id):
     if session.get('teacher_name') != 'Admin':  # Replace with proper admin check
         return redirect(url_for('chat'))
     
-    conn = sqlite3.connect('teachers_portal.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('UPDATE teachers SET is_approved = 1 WHERE id = ?', (teacher_id,))
     conn.commit()
-    conn.close()
+    invalidate_teacher_approval(teacher_id)
     
     flash('Teacher approved successfully!', 'success')
     return redirect(url_for('admin'))
 
 @app.route('/admin/reject/<int:teacher_id>')
 def reject_teacher(teacher_id):
-    conn = sqlite3.connect('teachers_portal.db')
+    conn = get_db()
     c = conn.cursor()
     
     # You can either delete the record or mark as rejected
     c.execute('DELETE FROM teachers WHERE id = ?', (teacher_id,))
     conn.commit()
-    conn.close()
+    invalidate_teacher_approval(teacher_id)
     
     flash('Teacher rejected and removed!', 'success')
     return redirect(url_for('admin'))
@@ -613,12 +2279,11 @@ def generate_code():
     # Generate random code
     code = 'BISHOP' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
     
-    conn = sqlite3.connect('teachers_portal.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('INSERT INTO registration_codes (code, created_by) VALUES (?, ?)',
              (code, session['teacher_name']))
     conn.commit()
-    conn.close()
     
     return redirect(url_for('admin'))
 
@@ -627,39 +2292,270 @@ def logout():
     session.clear()
     return redirect(url_for('login'))
 
+# Coalesced chat broadcasts
+SOCKET_EMIT_WINDOW = int(os.environ.get('SOCKET_EMIT_WINDOW_MS', 100)) / 1000
+
+class EmitScheduler:
+    """Batches bursty chat broadcasts into at most one frame per event type per window.
+
+    New messages go out together as one 'new_messages' frame, reaction updates
+    as one 'reactions_updated' frame where the latest counts for a message win.
+    Deletions are sent after both, and cancel pending frames for that message.
+    A window of 0 sends everything straight away.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.started = False
+        self.new_messages = []
+        self.reactions = {}
+        self.deleted = []
+
+    def message(self, message):
+        with self.lock:
+            self.new_messages.append(message)
+        self.schedule()
+
+    def reaction(self, message_id, reactions):
+        with self.lock:
+            self.reactions[message_id] = reactions
+        self.schedule()
+
+    def delete(self, message_id):
+        with self.lock:
+            self.reactions.pop(message_id, None)
+            unsent = [m for m in self.new_messages if m['id'] == message_id]
+            if unsent:
+                # Nobody has seen it yet, so there is nothing to delete
+                self.new_messages.remove(unsent[0])
+            else:
+                self.deleted.append(message_id)
+        self.schedule()
+
+    def schedule(self):
+        if self.window <= 0:
+            self.flush()
+            return
+        if not self.started:
+            with self.lock:
+                if not self.started:
+                    threading.Thread(target=self.run, daemon=True).start()
+                    self.started = True
+        self.pending.set()
+
+    def run(self):
+        while True:
+            self.pending.wait()
+            time.sleep(self.window)
+            self.pending.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing chat broadcasts: {e}")
+
+    def flush(self):
+        with self.lock:
+            new_messages, self.new_messages = self.new_messages, []
+            reactions, self.reactions = self.reactions, {}
+            deleted, self.deleted = self.deleted, []
+        
+        if new_messages:
+            socketio.emit('new_messages', new_messages)
+        if reactions:
+            socketio.emit('reactions_updated', [
+                {'message_id': message_id, 'reactions': counts}
+                for message_id, counts in reactions.items()
+            ])
+        for message_id in deleted:
+            socketio.emit('message_deleted', {'message_id': message_id})
+
+chat_broadcasts = EmitScheduler(SOCKET_EMIT_WINDOW)
+
 # API Routes
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 200
+
+def parse_cursor(name):
+    """Read an optional positive integer cursor from the query string"""
+    value = request.args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer')
+    if value < 0:
+        raise ValueError(f'{name} must be positive')
+    return value
+
+def fetch_reaction_counts(c, message_ids):
+    """Get reaction counts for a page of messages, keyed by message id"""
+    reactions = {message_id: {} for message_id in message_ids}
+    if not message_ids:
+        return reactions
+    placeholders = ','.join('?' * len(message_ids))
+    c.execute(f'''
+        SELECT message_id, reaction, count
+        FROM message_reaction_counts
+        WHERE message_id IN ({placeholders})
+    ''', message_ids)
+    for message_id, reaction, count in c.fetchall():
+        reactions[message_id][reaction] = count
+    return reactions
+
+def fetch_messages_page(c, before_id=None, after_id=None, limit=MESSAGES_PAGE_SIZE):
+    """Fetch one page of messages in ascending id order.
+
+    With after_id the page starts right after that id (oldest first), otherwise
+    it is the newest page ending before before_id. One extra row is read to
+    tell whether more messages exist past the page. Hot and archived messages
+    are each read with an indexed, limited scan and merged.
+    """
+    conditions = []
+    params = []
+    if before_id is not None:
+        conditions.append('m.id < ?')
+        params.append(before_id)
+    if after_id is not None:
+        conditions.append('m.id > ?')
+        params.append(after_id)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'ASC' if after_id is not None else 'DESC'
+
+    rows = []
+    for table in ('messages', 'messages_archive'):
+        c.execute(f'''
+            SELECT m.id, m.content, m.reply_to, m.created_at, t.first_name
+            FROM {table} m
+            JOIN teachers t ON m.sender_id = t.id
+            {where}
+            ORDER BY m.id {order}
+            LIMIT ?
+        ''', params + [limit + 1])
+        rows.extend(c.fetchall())
+    rows.sort(key=lambda row: row[0], reverse=(order == 'DESC'))
+    rows = rows[:limit + 1]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == 'DESC':
+        rows.reverse()
+
+    reactions = fetch_reaction_counts(c, [row[0] for row in rows])
+    messages = [{
+        'id': row[0],
+        'content': row[1],
+        'reply_to': row[2],
+        'created_at': row[3],
+        'sender': row[4],
+        'reactions': reactions[row[0]]
+    } for row in rows]
+    return messages, has_more
+
 @app.route('/api/messages')
 @login_required
 def get_messages():
-    conn = sqlite3.connect('teachers_portal.db')
+    """Get a page of chat messages.
+
+    Query parameters:
+      limit     - page size (default 50, max 200)
+      before_id - page of messages older than this id (scrolling back)
+      after_id  - messages newer than this id (delta after a reconnect)
+      since     - alias for after_id
+    Without a cursor the latest page is returned.
+    """
+    try:
+        before_id = parse_cursor('before_id')
+        after_id = parse_cursor('after_id')
+        if after_id is None:
+            after_id = parse_cursor('since')
+        limit = parse_cursor('limit')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if limit is None:
+        limit = MESSAGES_PAGE_SIZE
+    limit = max(1, min(limit, MESSAGES_MAX_PAGE_SIZE))
+
+    conn = get_db()
     c = conn.cursor()
+    messages, has_more = fetch_messages_page(c, before_id, after_id, limit)
+
+    return jsonify({
+        'messages': messages,
+        'has_more': has_more,
+        'oldest_id': messages[0]['id'] if messages else None,
+        'newest_id': messages[-1]['id'] if messages else None
+    })
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+# Control characters can't appear in chat text, so they mark matches in snippets
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+
+def search_query(text):
+    """Turn free text into an FTS5 query matching every word as a prefix"""
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text))
+
+def highlight_snippet(snippet):
+    """Escape a snippet and turn the match markers into <mark> tags"""
+    return (html.escape(snippet)
+            .replace(SNIPPET_START, '<mark>')
+            .replace(SNIPPET_END, '</mark>'))
+
+@app.route('/api/messages/search')
+@login_required
+def search_messages():
+    """Ranked full-text search over chat history.
+
+    Query parameters: q (words, matched as prefixes), limit (default 20,
+    max 50) and offset. Archived messages are searched too.
+    """
+    match = search_query(request.args.get('q', ''))
+    if not match:
+        return jsonify({'error': 'q is required'}), 400
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), SEARCH_MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    
+    # Rank the page of matches first, then look each one up by primary key
+    # (joining the all_messages view directly would scan both tables)
+    c = get_db().cursor()
     c.execute('''
-        SELECT m.id, m.content, m.reply_to, m.created_at, t.first_name,
-               GROUP_CONCAT(r.reaction || ':' || COUNT(r.reaction)) as reactions
-        FROM messages m
+        WITH hits AS MATERIALIZED (
+            SELECT rowid AS id, rank, snippet(messages_fts, 0, ?, ?, '…', 16) AS snippet
+            FROM messages_fts
+            WHERE messages_fts MATCH ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+        )
+        SELECT m.id, m.content, m.reply_to, m.created_at, t.first_name, hits.snippet, hits.rank
+        FROM hits
+        JOIN messages m ON m.id = hits.id
         JOIN teachers t ON m.sender_id = t.id
-        LEFT JOIN reactions r ON m.id = r.message_id
-        GROUP BY m.id
-        ORDER BY m.created_at ASC
-    ''')
-    messages = []
-    for row in c.fetchall():
-        reactions = {}
-        if row[5]:
-            for reaction_data in row[5].split(','):
-                reaction, count = reaction_data.split(':')
-                reactions[reaction] = int(count)
-        
-        messages.append({
-            'id': row[0],
-            'content': row[1],
-            'reply_to': row[2],
-            'created_at': row[3],
-            'sender': row[4],
-            'reactions': reactions
-        })
-    conn.close()
-    return jsonify(messages)
+        UNION ALL
+        SELECT m.id, m.content, m.reply_to, m.created_at, t.first_name, hits.snippet, hits.rank
+        FROM hits
+        JOIN messages_archive m ON m.id = hits.id
+        JOIN teachers t ON m.sender_id = t.id
+        ORDER BY 7
+    ''', (SNIPPET_START, SNIPPET_END, match, limit + 1, offset))
+    rows = c.fetchall()
+    
+    results = [{
+        'id': row[0],
+        'content': row[1],
+        'reply_to': row[2],
+        'created_at': row[3],
+        'sender': row[4],
+        'snippet': highlight_snippet(row[5])
+    } for row in rows[:limit]]
+    return jsonify({
+        'results': results,
+        'has_more': len(rows) > limit,
+        'offset': offset,
+        'limit': limit
+    })
 
 @app.route('/api/messages', methods=['POST'])
 @login_required
@@ -668,7 +2564,7 @@ def send_message():
     content = data.get('content')
     reply_to = data.get('reply_to')
     
-    conn = sqlite3.connect('teachers_portal.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('INSERT INTO messages (sender_id, content, reply_to) VALUES (?, ?, ?)',
              (session['teacher_id'], content, reply_to))
@@ -683,7 +2579,6 @@ def send_message():
         WHERE m.id = ?
     ''', (message_id,))
     message_data = c.fetchone()
-    conn.close()
     
     message = {
         'id': message_data[0],
@@ -695,30 +2590,32 @@ def send_message():
     }
     
     # Broadcast to all connected clients
-    socketio.emit('new_message', message)
+    chat_broadcasts.message(message)
     return jsonify(message)
 
 @app.route('/api/messages/<int:message_id>', methods=['DELETE'])
 @login_required
 def delete_message(message_id):
-    conn = sqlite3.connect('teachers_portal.db')
+    conn = get_db()
     c = conn.cursor()
     # Only allow deletion of own messages
     c.execute('DELETE FROM messages WHERE id = ? AND sender_id = ?',
              (message_id, session['teacher_id']))
+    if c.rowcount == 0:
+        c.execute('DELETE FROM messages_archive WHERE id = ? AND sender_id = ?',
+                 (message_id, session['teacher_id']))
     conn.commit()
     
     if c.rowcount > 0:
         # Also delete associated reactions
         c.execute('DELETE FROM reactions WHERE message_id = ?', (message_id,))
+        c.execute('DELETE FROM reactions_archive WHERE message_id = ?', (message_id,))
         conn.commit()
-        conn.close()
         
         # Broadcast deletion
-        socketio.emit('message_deleted', {'message_id': message_id})
+        chat_broadcasts.delete(message_id)
         return jsonify({'success': True})
     else:
-        conn.close()
         return jsonify({'error': 'Message not found or unauthorized'}), 403
 
 @app.route('/api/messages/<int:message_id>/react', methods=['POST'])
@@ -727,55 +2624,52 @@ def react_to_message(message_id):
     data = request.json
     reaction = data.get('reaction')
     
-    conn = sqlite3.connect('teachers_portal.db')
+    conn = get_db()
     c = conn.cursor()
     
-    # Check if reaction already exists
-    c.execute('SELECT id FROM reactions WHERE message_id = ? AND teacher_id = ? AND reaction = ?',
+    # Remove the reaction if it exists (hot or archived), otherwise add it
+    c.execute('DELETE FROM reactions WHERE message_id = ? AND teacher_id = ? AND reaction = ?',
              (message_id, session['teacher_id'], reaction))
-    existing = c.fetchone()
-    
-    if existing:
-        # Remove reaction
-        c.execute('DELETE FROM reactions WHERE message_id = ? AND teacher_id = ? AND reaction = ?',
+    if c.rowcount == 0:
+        c.execute('DELETE FROM reactions_archive WHERE message_id = ? AND teacher_id = ? AND reaction = ?',
                  (message_id, session['teacher_id'], reaction))
-    else:
-        # Add reaction
+    if c.rowcount == 0:
         c.execute('INSERT INTO reactions (message_id, teacher_id, reaction) VALUES (?, ?, ?)',
                  (message_id, session['teacher_id'], reaction))
     
-    conn.commit()
-    
-    # Get updated reaction counts
-    c.execute('''
-        SELECT reaction, COUNT(*) as count
-        FROM reactions
-        WHERE message_id = ?
-        GROUP BY reaction
-    ''', (message_id,))
+    # Get updated reaction counts (maintained by triggers)
+    c.execute('SELECT reaction, count FROM message_reaction_counts WHERE message_id = ?', (message_id,))
     reactions = {row[0]: row[1] for row in c.fetchall()}
-    conn.close()
+    conn.commit()
     
     # Broadcast reaction update
-    socketio.emit('reaction_updated', {
-        'message_id': message_id,
-        'reactions': reactions
-    })
+    chat_broadcasts.reaction(message_id, reactions)
     
     return jsonify({'reactions': reactions})
 
 # WebSocket events
 @socketio.on('connect')
-def on_connect():
+@socket_metrics('connect')
+def on_connect(auth=None):
+    metrics.inc('socketio_connected_clients')
     if 'teacher_id' in session:
         join_room('teachers')
         emit('status', {'msg': f"{session['teacher_name']} has connected"})
 
 @socketio.on('disconnect')
-def on_disconnect():
+@socket_metrics('disconnect')
+def on_disconnect(*args):
+    metrics.inc('socketio_connected_clients', value=-1)
     if 'teacher_id' in session:
         leave_room('teachers')
 
+@socketio.on('watch_donation')
+@socket_metrics('watch_donation')
+def on_watch_donation(data):
+    reference = (data or {}).get('reference')
+    if reference:
+        join_room(f'donation_{reference}')
+
 
 @app.route('/admin')
 def admin():
@@ -784,33 +2678,95 @@ def admin():
         return redirect(url_for('admin_login'))
     
     announcements = load_announcements()
-    donations = load_donations()
-    
-    # ✅ ADD THIS: Load alumni data
-    alumni = load_alumni_data()
-    
-    # Calculate donation statistics
-    total_donations = sum(d['amount'] for d in donations if d['status'] == 'completed')
-    successful_donations = len([d for d in donations if d['status'] == 'completed'])
-    pending_donations = len([d for d in donations if d['status'] == 'pending'])
     
-    # ✅ ADD THIS: Calculate alumni stats
-    total_alumni = len(alumni)
+    # Donation and alumni statistics (kept up to date by triggers)
+    stats = load_stats()
+    alumni_summary = load_alumni_summary()
     
-    stats = {
-        'total_amount': total_donations,
-        'successful_count': successful_donations,
-        'pending_count': pending_donations,
-        'total_attempts': len(donations),
-        'total_alumni': total_alumni  # ✅ Add this for the stats section
-    }
-    
-    # ✅ ADD 'alumni=alumni' to the render_template call
+    # The donation and alumni tables are fetched page by page from the admin API
     return render_template('admin.html', 
                          announcements=announcements, 
-                         donations=donations, 
                          stats=stats,
-                         alumni=alumni)  # ✅ This was missing!
+                         alumni_summary=alumni_summary)
+
+@app.route('/admin/api/donations')
+def admin_donations():
+    """Paginated donations for the admin dashboard.
+
+    Filters: status, date_from, date_to (YYYY-MM-DD), name (substring).
+    Sort by date, amount, name or status.
+    """
+    if not is_admin_logged_in():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        page, per_page, sort, order = page_args(['date', 'amount', 'name', 'status'], 'date')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    filters = []
+    if request.args.get('status'):
+        filters.append(('status = ?', request.args['status']))
+    if request.args.get('date_from'):
+        filters.append(('date >= ?', request.args['date_from']))
+    if request.args.get('date_to'):
+        filters.append(('date <= ?', f"{request.args['date_to']} 23:59:59"))
+    if request.args.get('name'):
+        filters.append(('name LIKE ?', f"%{request.args['name']}%"))
+    
+    return jsonify(query_page('donations',
+                              'id, reference, name, phone, amount, status, date, mpesa_receipt, error',
+                              filters, sort, order, page, per_page))
+
+@app.route('/admin/api/alumni')
+def admin_alumni():
+    """Paginated alumni for the admin dashboard.
+
+    Filters: name (substring), year_finished, year_from/year_to (year finished range).
+    Sort by id, name, year_started, year_finished or submitted_at.
+    """
+    if not is_admin_logged_in():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        page, per_page, sort, order = page_args(
+            ['id', 'name', 'year_started', 'year_finished', 'submitted_at'], 'id')
+        filters = []
+        if request.args.get('name'):
+            filters.append(('name LIKE ?', f"%{request.args['name']}%"))
+        if request.args.get('year_finished'):
+            filters.append(('year_finished = ?', int(request.args['year_finished'])))
+        if request.args.get('year_from'):
+            filters.append(('year_finished >= ?', int(request.args['year_from'])))
+        if request.args.get('year_to'):
+            filters.append(('year_finished <= ?', int(request.args['year_to'])))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify(query_page('alumni', '*', filters, sort, order, page, per_page))
+
+@app.route('/admin/stats')
+def admin_stats():
+    """Dashboard statistics as JSON, with daily and monthly rollups"""
+    if not is_admin_logged_in():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        days = max(1, min(int(request.args.get('days', 30)), 366))
+        months = max(1, min(int(request.args.get('months', 12)), 120))
+    except ValueError:
+        return jsonify({'error': 'days and months must be numbers'}), 400
+    
+    today = datetime.now().date()
+    first_day = (today - timedelta(days=days - 1)).isoformat()
+    month_index = today.year * 12 + today.month - months
+    first_month = f'{month_index // 12:04d}-{month_index % 12 + 1:02d}'
+    
+    return jsonify({
+        'totals': load_stats(),
+        'daily': load_stats_series('day', first_day),
+        'monthly': load_stats_series('month', first_month)
+    })
 
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
@@ -846,15 +2802,12 @@ def add_announcement():
     emoji = request.form.get('emoji', '📢')
     
     if title and content:
-        announcements = load_announcements()
-        new_announcement = {
-            'id': len(announcements) + 1,
+        add_announcement_record({
             'title': f"{emoji} {title}",
             'content': content,
             'date': datetime.now().strftime('%B %d, %Y')
-        }
-        announcements.insert(0, new_announcement)
-        save_announcements(announcements)
+        })
+        invalidate_index_page()
         flash('Announcement added successfully!', 'success')
     
     return redirect(url_for('admin'))
@@ -865,12 +2818,40 @@ def delete_announcement(announcement_id):
     if not is_admin_logged_in():
         return redirect(url_for('admin_login'))
     
-    announcements = load_announcements()
-    announcements = [a for a in announcements if a['id'] != announcement_id]
-    save_announcements(announcements)
+    delete_announcement_record(announcement_id)
+    invalidate_index_page()
     flash('Announcement deleted successfully!', 'success')
     return redirect(url_for('admin'))
 
+ALUMNI_FIELDS = ['alumni-name', 'alumni-phone', 'year-started', 'year-finished']
+
+def validate_alumni(dat):
+    """Check an alumni submission, returning (record, None) or (None, error message)"""
+    for field in ALUMNI_FIELDS:
+        if not dat.get(field):
+            return None, f'Missing required field: {field}'
+    
+    try:
+        year_started = int(dat['year-started'])
+        year_finished = int(dat['year-finished'])
+    except (ValueError, TypeError):
+        return None, 'Years must be valid numbers'
+    
+    if year_started < 1950 or year_started > 2030:
+        return None, 'Year started must be between 1950 and 2030'
+    if year_finished < 1950 or year_finished > 2030:
+        return None, 'Year finished must be between 1950 and 2030'
+    if year_finished < year_started:
+        return None, 'Year finished cannot be earlier than year started'
+    
+    return {
+        'name': str(dat['alumni-name']).strip(),
+        'phone': str(dat['alumni-phone']).strip(),
+        'year_started': year_started,
+        'year_finished': year_finished,
+        'submitted_at': datetime.now().isoformat()
+    }, None
+
 @app.route('/submit-alumni', methods=['POST'])
 def submit_alumni():
     """Handle alumni form submission"""
@@ -884,50 +2865,17 @@ def submit_alumni():
         if not dat:
             return jsonify({'error': 'No data provided'}), 400
         
-        # Validate required fields
-        required_fields = ['alumni-name', 'alumni-phone', 'year-started', 'year-finished']
-        for field in required_fields:
-            if not dat.get(field):
-                return jsonify({'error': f'Missing required field: {field}'}), 400
-        
-        # Validate year fields
-        try:
-            year_started = int(dat['year-started'])
-            year_finished = int(dat['year-finished'])
-            
-            if year_started < 1950 or year_started > 2030:
-                return jsonify({'error': 'Year started must be between 1950 and 2030'}), 400
-            
-            if year_finished < 1950 or year_finished > 2030:
-                return jsonify({'error': 'Year finished must be between 1950 and 2030'}), 400
-            
-            if year_finished < year_started:
-                return jsonify({'error': 'Year finished cannot be earlier than year started'}), 400
-                
-        except ValueError:
-            return jsonify({'error': 'Years must be valid numbers'}), 400
-        
-        # Load existing data
-        alumni_data = load_alumni_data()
-        
-        # Create new alumni record
-        new_alumni = {
-            'id': len(alumni_data) + 1,
-            'name': dat['alumni-name'].strip(),
-            'phone': dat['alumni-phone'].strip(),
-            'year_started': year_started,
-            'year_finished': year_finished,
-            'submitted_at': datetime.now().isoformat()
-        }
-        
-        # Add to data list
-        alumni_data.append(new_alumni)
+        # Validate and build the new alumni record
+        new_alumni, error = validate_alumni(dat)
+        if error:
+            return jsonify({'error': error}), 400
         
-        # Save to file
-        if save_alumni_data(alumni_data):
+        # Save to database
+        alumni_id = add_alumni(new_alumni)
+        if alumni_id:
             return jsonify({
                 'message': 'Alumni registration submitted successfully',
-                'alumni_id': new_alumni['id']
+                'alumni_id': alumni_id
             }), 201
         else:
             return jsonify({'error': 'Failed to save data'}), 500
@@ -936,14 +2884,200 @@ def submit_alumni():
         print(f"Error processing alumni submission: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+# Bulk export and import
+EXPORT_COLUMNS = {
+    'alumni': ['id', 'name', 'phone', 'year_started', 'year_finished', 'submitted_at'],
+    'donations': ['id', 'reference', 'name', 'phone', 'amount', 'status', 'date',
+                  'mpesa_receipt', 'error', 'completed_date'],
+}
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+EXPORT_CHUNK_ROWS = 500
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_ERRORS = 100  # rejected rows listed in the import response
+
+# CSV/NDJSON exports use the column names, the form uses its own field names
+IMPORT_FIELD_ALIASES = {
+    'name': 'alumni-name',
+    'phone': 'alumni-phone',
+    'year_started': 'year-started',
+    'year_finished': 'year-finished',
+}
+
+def export_rows(table, columns):
+    """Yield a table's rows in id order, a chunk at a time.
+
+    Runs after the view has returned, so it uses a connection of its own
+    rather than the request's pooled one.
+    """
+    conn = connect_db()
+    try:
+        c = conn.cursor()
+        c.execute(f'SELECT {", ".join(columns)} FROM {table} ORDER BY id')
+        while True:
+            rows = c.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                return
+            yield rows
+    finally:
+        conn.close()
+
+def csv_chunks(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+def ndjson_chunks(columns, chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows)
+
+@app.route('/admin/export/<any(alumni, donations):table>.<any(csv, ndjson):fmt>')
+def export_store(table, fmt):
+    """Stream all alumni or donations as CSV or NDJSON"""
+    if not is_admin_logged_in():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    columns = EXPORT_COLUMNS[table]
+    chunks = export_rows(table, columns)
+    body = csv_chunks(columns, chunks) if fmt == 'csv' else ndjson_chunks(columns, chunks)
+    filename = f"{table}_{datetime.now().strftime('%Y-%m-%d')}.{fmt}"
+    return Response(body, mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def import_rows(stream, fmt):
+    """Yield (line number, record) from an uploaded CSV or NDJSON stream, one row at a time"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+def insert_alumni_batch(conn, batch):
+    c = conn.cursor()
+    c.executemany('''INSERT INTO alumni (name, phone, year_started, year_finished, submitted_at)
+                     VALUES (:name, :phone, :year_started, :year_finished, :submitted_at)''', batch)
+    conn.commit()
+
+@app.route('/admin/import/alumni', methods=['POST'])
+def import_alumni():
+    """Bulk-load alumni from a CSV or NDJSON upload.
+
+    Accepts a multipart 'file' field or a raw request body. The format comes
+    from ?format=csv|ndjson, the file extension or the content type. Rows
+    are checked with the same rules as /submit-alumni and saved
+    IMPORT_BATCH_SIZE at a time; rejected rows are reported by line number.
+    """
+    if not is_admin_logged_in():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    upload = request.files.get('file')
+    if upload:
+        stream, filename, mimetype = upload.stream, upload.filename or '', upload.mimetype
+    else:
+        stream, filename, mimetype = request.stream, '', request.mimetype
+    fmt = request.args.get('format')
+    if not fmt:
+        ndjson = filename.endswith(('.ndjson', '.jsonl')) or mimetype in ('application/x-ndjson', 'application/jsonl')
+        fmt = 'ndjson' if ndjson else 'csv'
+    if fmt not in EXPORT_MIMETYPES:
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    
+    conn = get_db()
+    imported = 0
+    rejected = 0
+    errors = []
+    batch = []
+    try:
+        for line, row in import_rows(stream, fmt):
+            if isinstance(row, dict):
+                dat = {IMPORT_FIELD_ALIASES.get(key, key): value for key, value in row.items()}
+                record, error = validate_alumni(dat)
+                # Keep the original registration time when re-importing an export
+                if record and dat.get('submitted_at'):
+                    try:
+                        record['submitted_at'] = datetime.fromisoformat(str(dat['submitted_at'])).isoformat()
+                    except ValueError:
+                        record, error = None, 'submitted_at must be an ISO 8601 date and time'
+            else:
+                record, error = None, 'Row is not a JSON object'
+            if error:
+                rejected += 1
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append({'line': line, 'error': error})
+                continue
+            
+            batch.append(record)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                insert_alumni_batch(conn, batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            insert_alumni_batch(conn, batch)
+            imported += len(batch)
+    except (csv.Error, UnicodeDecodeError) as e:
+        conn.rollback()
+        return jsonify({'error': f'Could not read upload: {e}', 'imported': imported}), 400
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"Error importing alumni: {e}")
+        return jsonify({'error': 'Failed to save data', 'imported': imported}), 500
+    
+    return jsonify({
+        'imported': imported,
+        'rejected': rejected,
+        'errors': errors,
+        'errors_truncated': rejected > len(errors)
+    })
+
+ALUMNI_LIST_PAGE_SIZE = 50
+ALUMNI_LIST_MAX_PAGE_SIZE = 200
+
+def year_range_arg(name):
+    """Read an exact year (name) or a range (name_from / name_to) from the query string"""
+    exact = request.args.get(name, type=int)
+    if exact is not None:
+        return exact, exact
+    return request.args.get(f'{name}_from', type=int), request.args.get(f'{name}_to', type=int)
+
 @app.route('/alumni-list', methods=['GET'])
 def get_alumni_list():
-    """Get list of all alumni (optional endpoint for viewing data)"""
+    """Search the alumni list.
+
+    Query parameters:
+      q                      - name prefix(es), e.g. "jav oti"
+      phone                  - phone number in any local format
+      year_started           - exact year, or year_started_from / year_started_to
+      year_finished          - exact year, or year_finished_from / year_finished_to
+      limit, offset          - paging (default 50, max 200)
+    """
     try:
-        alumni_data = load_alumni_data()
+        index = get_alumni_index()
+        ids = index.search(
+            q=request.args.get('q'),
+            phone=request.args.get('phone'),
+            year_started=year_range_arg('year_started'),
+            year_finished=year_range_arg('year_finished')
+        )
+        limit = max(1, min(request.args.get('limit', ALUMNI_LIST_PAGE_SIZE, type=int), ALUMNI_LIST_MAX_PAGE_SIZE))
+        offset = max(0, request.args.get('offset', 0, type=int))
         return jsonify({
-            'alumni': alumni_data,
-            'total': len(alumni_data)
+            'alumni': [index.records[alumni_id] for alumni_id in ids[offset:offset + limit]],
+            'total': len(ids),
+            'limit': limit,
+            'offset': offset
         })
     except Exception as e:
         return jsonify({'error': 'Failed to retrieve alumni data'}), 500
@@ -969,10 +3103,19 @@ def robots_txt():
     """Robots.txt file to allow all crawlers"""
     return send_from_directory(app.root_path, 'robots.txt')
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics for this worker, for admins or a scraper sending METRICS_TOKEN"""
+    authorization = request.headers.get('Authorization', '')
+    token_ok = METRICS_TOKEN and secrets.compare_digest(authorization, f'Bearer {METRICS_TOKEN}')
+    if not (token_ok or is_admin_logged_in()):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy'})
+    return jsonify({'status': 'healthy', 'mpesa': mpesa_breaker.state})
 
 
 if __name__ == '__main__':
@@ -981,16 +3124,6 @@ if __name__ == '__main__':
     # Create directories
     os.makedirs('templates', exist_ok=True)
     
-    # Initialize data files
-    if not os.path.exists(ANNOUNCEMENTS_FILE):
-        save_announcements([])
-    
-    if not os.path.exists(DONATIONS_FILE):
-        save_donations([])
-
-    if not os.path.exists(ALUMNI_DATA_FILE):
-        save_alumni_data([])
-    
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
     # socketio.run(app, debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
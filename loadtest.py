@@ -0,0 +1,512 @@
+"""Load test and benchmark harness for the school site.
+
+Boots app.py under gunicorn (eventlet, as on Render) against temporary copies
+of the JSON stores and teachers_portal.db, points it at a local stand-in for
+the Safaricom Daraja API, then drives a weighted mix of page views, donations,
+M-Pesa callbacks, alumni submissions, chat API calls and Socket.IO clients.
+
+Throughput and p50/p95/p99 latency per route are written as JSON so runs can
+be compared across releases:
+
+    python loadtest.py --duration 60 --users 20 --sockets 10 --output run.json
+
+The exit status is 1 if any route's error rate is above --max-error-rate, so
+the run can gate a release.
+
+Besides the app's requirements (gunicorn below 26, which still ships the
+eventlet worker), the Socket.IO clients need websocket-client; without it
+they fall back to long-polling:
+
+    pip install -r requirements.txt websocket-client
+"""
+import argparse
+import json
+import math
+import os
+import queue
+import random
+import shutil
+import socket
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import socketio
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_FILES = ['announcements.json', 'donations.json', 'alumni_data.json', 'teachers_portal.db']
+
+BENCH_TEACHER = {'first_name': 'Loadtest', 'email': 'loadtest@example.com', 'password': 'loadtest'}
+
+DEFAULT_MIX = {
+    'home': 40,
+    'support': 10,
+    'callback': 10,
+    'submit_alumni': 10,
+    'messages': 20,
+    'chat': 10,
+}
+
+# Fake Daraja server
+
+class FakeDaraja:
+    """Local stand-in for the Daraja OAuth and STK push endpoints.
+
+    Every response is delayed by `latency` seconds (plus up to `jitter`), and
+    a `failure_rate` fraction of STK pushes answer a bare 503 from the gateway,
+    with no Daraja error body, so the app's STK retry and backoff path is
+    exercised. Accepted CheckoutRequestIDs are queued for the callback
+    scenario to settle.
+    """
+
+    def __init__(self, latency=0.2, jitter=0.1, failure_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.checkouts = queue.Queue()
+        self.counts = {'token': 0, 'stk': 0, 'stk_failed': 0}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except ConnectionError:
+                    # The app dropping pooled keep-alive connections as it shuts down
+                    pass
+
+            def _send(self, status, body, content_type='application/json'):
+                data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                fake._delay()
+                fake._count('token')
+                self._send(200, {'access_token': 'loadtest-token', 'expires_in': '3599'})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                fake._delay()
+                if random.random() < fake.failure_rate:
+                    fake._count('stk_failed')
+                    self._send(503, 'Service Unavailable', 'text/plain')
+                    return
+                number = fake._count('stk')
+                checkout_id = f'ws_CO_loadtest_{number}'
+                fake.checkouts.put(checkout_id)
+                self._send(200, {
+                    'ResponseCode': '0',
+                    'ResponseDescription': 'Success. Request accepted for processing',
+                    'MerchantRequestID': f'loadtest-{number}',
+                    'CheckoutRequestID': checkout_id,
+                })
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+
+    def _delay(self):
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+            return self.counts[name]
+
+# App under test
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def prepare_workdir(workdir):
+    """Copy the data stores into workdir and add an approved chat account"""
+    for name in DATA_FILES:
+        source = os.path.join(APP_DIR, name)
+        if os.path.exists(source):
+            shutil.copy2(source, os.path.join(workdir, name))
+
+def seed_teacher(workdir):
+    conn = sqlite3.connect(os.path.join(workdir, 'teachers_portal.db'))
+    conn.execute('''INSERT OR IGNORE INTO teachers (first_name, email, password, is_approved)
+                    VALUES (?, ?, ?, 1)''',
+                 (BENCH_TEACHER['first_name'], BENCH_TEACHER['email'], BENCH_TEACHER['password']))
+    conn.execute('UPDATE teachers SET is_approved = 1 WHERE email = ?', (BENCH_TEACHER['email'],))
+    conn.commit()
+    conn.close()
+
+def start_app(workdir, port, mpesa_url, worker_class='eventlet', threads=1, extra_env=None):
+    """Import the JSON stores and start gunicorn the way render.yaml does"""
+    env = dict(os.environ)
+    env.update({
+        'SECRET_KEY': 'loadtest',
+        'MPESA_BASE_URL': mpesa_url,
+        'MPESA_CONSUMER_KEY': 'loadtest',
+        'MPESA_CONSUMER_SECRET': 'loadtest',
+        'MPESA_SHORTCODE': '174379',
+        'MPESA_PASSKEY': 'loadtest',
+        'MPESA_CALLBACK_URL': f'http://127.0.0.1:{port}/mpesa/callback',
+        'ACCOUNT_REFERENCE': 'LOADTEST',
+    })
+    if worker_class != 'eventlet':
+        env['SOCKETIO_ASYNC_MODE'] = 'threading'
+    env.update(extra_env or {})
+
+    app_path = os.path.join(APP_DIR, 'app.py')
+    subprocess.run([sys.executable, '-m', 'flask', '--app', app_path, 'import-json'],
+                   cwd=workdir, env=env, check=True, stdout=subprocess.DEVNULL)
+    seed_teacher(workdir)
+
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    command = [sys.executable, '-m', 'gunicorn', '-k', worker_class, '-w', '1',
+               '--chdir', workdir, '--pythonpath', APP_DIR,
+               '-b', f'127.0.0.1:{port}', 'app:app']
+    if worker_class == 'gthread':
+        command[5:5] = ['--threads', str(threads)]
+    server = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'App exited early, see {log.name}')
+        try:
+            requests.get(f'{base_url}/health', timeout=1)
+            return server, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f'App did not start within 30s, see {log.name}')
+
+# Measurements
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+class Recorder:
+    """Collects latencies and error counts per route from all workers"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, ok=True):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, elapsed):
+        routes = {}
+        for route, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            ms = lambda value: round(value * 1000, 2)
+            routes[route] = {
+                'requests': len(values),
+                'errors': self.errors.get(route, 0),
+                'throughput_rps': round(len(values) / elapsed, 2) if elapsed else None,
+                'mean_ms': ms(sum(values) / len(values)),
+                'p50_ms': ms(percentile(values, 50)),
+                'p95_ms': ms(percentile(values, 95)),
+                'p99_ms': ms(percentile(values, 99)),
+                'max_ms': ms(values[-1]),
+            }
+        return routes
+
+# Scenarios
+
+def random_name():
+    return ' '.join(''.join(random.choices(string.ascii_lowercase, k=6)).title() for _ in range(2))
+
+def random_phone():
+    return '07' + ''.join(random.choices(string.digits, k=8))
+
+def timed(recorder, route, call, check=None):
+    start = time.perf_counter()
+    try:
+        response = call()
+    except requests.RequestException:
+        recorder.record(route, time.perf_counter() - start, ok=False)
+        return None
+    elapsed = time.perf_counter() - start
+    ok = response.status_code < 400 and (check is None or check(response))
+    recorder.record(route, elapsed, ok)
+    return response
+
+def scenario_home(ctx, http):
+    timed(ctx.recorder, 'GET /', lambda: http.get(f'{ctx.base_url}/', timeout=ctx.timeout))
+
+def scenario_support(ctx, http):
+    body = {'name': random_name(), 'phone': random_phone(), 'amount': random.choice([50, 100, 500, 1000])}
+    timed(ctx.recorder, 'POST /support',
+          lambda: http.post(f'{ctx.base_url}/support', json=body, timeout=ctx.timeout),
+          check=lambda response: response.json().get('success'))
+
+def scenario_callback(ctx, http):
+    try:
+        checkout_id = ctx.daraja.checkouts.get_nowait()
+    except queue.Empty:
+        # Nothing to settle yet; keep the mix moving with a donation instead
+        scenario_support(ctx, http)
+        return
+    paid = random.random() < 0.9
+    callback = {
+        'MerchantRequestID': 'loadtest',
+        'CheckoutRequestID': checkout_id,
+        'ResultCode': 0 if paid else 1032,
+        'ResultDesc': 'The service request is processed successfully.' if paid else 'Request cancelled by user',
+    }
+    if paid:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 100},
+            {'Name': 'MpesaReceiptNumber', 'Value': 'LT' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))},
+            {'Name': 'PhoneNumber', 'Value': 254700000000},
+        ]}
+    timed(ctx.recorder, 'POST /mpesa/callback',
+          lambda: http.post(f'{ctx.base_url}/mpesa/callback', json={'Body': {'stkCallback': callback}},
+                            timeout=ctx.timeout))
+
+def scenario_submit_alumni(ctx, http):
+    year_started = random.randint(1980, 2020)
+    body = {
+        'alumni-name': random_name(),
+        'alumni-phone': random_phone(),
+        'year-started': year_started,
+        'year-finished': year_started + 4,
+    }
+    timed(ctx.recorder, 'POST /submit-alumni',
+          lambda: http.post(f'{ctx.base_url}/submit-alumni', json=body, timeout=ctx.timeout))
+
+def scenario_messages(ctx, http):
+    timed(ctx.recorder, 'GET /api/messages',
+          lambda: http.get(f'{ctx.base_url}/api/messages', timeout=ctx.timeout))
+
+def scenario_chat(ctx, http):
+    """Post a chat message and time its Socket.IO broadcast to a listener"""
+    start = time.perf_counter()
+    response = timed(ctx.recorder, 'POST /api/messages',
+                     lambda: http.post(f'{ctx.base_url}/api/messages',
+                                       json={'content': f'loadtest {random_name()}'}, timeout=ctx.timeout))
+    if response is None or response.status_code != 200 or not ctx.listener:
+        return
+    delivered = ctx.listener.wait_for(response.json()['id'], ctx.timeout)
+    ctx.recorder.record('socketio new_messages', time.perf_counter() - start, ok=delivered)
+
+SCENARIOS = {
+    'home': scenario_home,
+    'support': scenario_support,
+    'callback': scenario_callback,
+    'submit_alumni': scenario_submit_alumni,
+    'messages': scenario_messages,
+    'chat': scenario_chat,
+}
+
+# Socket.IO clients
+
+class ChatListener:
+    """Socket.IO client in the teachers room that notes broadcast message ids"""
+
+    def __init__(self, base_url, cookies, recorder, timeout):
+        self.client = socketio.Client(reconnection=False)
+        self.seen = {}
+        self._cond = threading.Condition()
+        self.client.on('new_messages', self._on_messages)
+        header = '; '.join(f'{name}={value}' for name, value in cookies.items())
+        start = time.perf_counter()
+        try:
+            self.client.connect(base_url, headers={'Cookie': header}, wait_timeout=timeout)
+            recorder.record('socketio connect', time.perf_counter() - start)
+        except socketio.exceptions.ConnectionError:
+            recorder.record('socketio connect', time.perf_counter() - start, ok=False)
+
+    def _on_messages(self, messages):
+        with self._cond:
+            for message in messages or []:
+                self.seen[message.get('id')] = True
+            self._cond.notify_all()
+
+    def wait_for(self, message_id, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.seen.pop(message_id, False), timeout)
+
+    def close(self):
+        if self.client.connected:
+            self.client.disconnect()
+
+# Runner
+
+class Context:
+    def __init__(self, base_url, daraja, recorder, timeout):
+        self.base_url = base_url
+        self.daraja = daraja
+        self.recorder = recorder
+        self.timeout = timeout
+        self.listener = None
+
+def login(base_url):
+    http = requests.Session()
+    http.post(f'{base_url}/teachers/login',
+              data={'email': BENCH_TEACHER['email'], 'password': BENCH_TEACHER['password']}, timeout=10)
+    # The app marks its session cookie Secure; the harness talks plain HTTP
+    for cookie in http.cookies:
+        cookie.secure = False
+    return http
+
+def worker(ctx, mix, deadline):
+    http = login(ctx.base_url)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while time.time() < deadline:
+        SCENARIOS[random.choices(names, weights)[0]](ctx, http)
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    if text:
+        for part in text.split(','):
+            name, _, weight = part.partition('=')
+            if name not in SCENARIOS:
+                raise argparse.ArgumentTypeError(f'Unknown scenario: {name}')
+            mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(args):
+    daraja = FakeDaraja(args.mpesa_latency / 1000, args.mpesa_jitter / 1000, args.mpesa_failure_rate)
+    mpesa_url = daraja.start()
+    recorder = Recorder()
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    server = None
+    listeners = []
+    try:
+        prepare_workdir(workdir)
+        server, base_url = start_app(workdir, args.port or free_port(), mpesa_url, args.worker_class,
+                                     args.users + args.sockets + 4, {'STK_RETRY_BACKOFF': '0.5'})
+        ctx = Context(base_url, daraja, recorder, args.timeout)
+
+        cookies = login(base_url).cookies.get_dict()
+        listeners = [ChatListener(base_url, cookies, recorder, args.timeout) for _ in range(args.sockets)]
+        ctx.listener = listeners[0] if listeners else None
+
+        mix = parse_mix(args.mix)
+        started = time.time()
+        deadline = started + args.duration
+        threads = [threading.Thread(target=worker, args=(ctx, mix, deadline), daemon=True)
+                   for _ in range(args.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        return {
+            'started_at': datetime.fromtimestamp(started, timezone.utc).isoformat(),
+            'git_revision': git_revision(),
+            'config': {
+                'duration_s': args.duration,
+                'users': args.users,
+                'sockets': args.sockets,
+                'worker_class': args.worker_class,
+                'mix': mix,
+                'mpesa_latency_ms': args.mpesa_latency,
+                'mpesa_jitter_ms': args.mpesa_jitter,
+                'mpesa_failure_rate': args.mpesa_failure_rate,
+            },
+            'elapsed_s': round(elapsed, 2),
+            'total_requests': sum(len(values) for values in recorder.latencies.values()),
+            'routes': recorder.summary(elapsed),
+            'daraja': dict(daraja.counts),
+        }
+    finally:
+        for listener in listeners:
+            listener.close()
+        if server:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        daraja.stop()
+        if args.keep_workdir:
+            print(f'Work directory kept at {workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def print_table(results):
+    print(f"{'route':<26}{'reqs':>7}{'errs':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}", file=sys.stderr)
+    for route, stats in results['routes'].items():
+        print(f"{route:<26}{stats['requests']:>7}{stats['errors']:>6}{stats['throughput_rps']:>9}"
+              f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to run the load (default 30)')
+    parser.add_argument('--users', type=int, default=10, help='Concurrent HTTP clients (default 10)')
+    parser.add_argument('--sockets', type=int, default=5, help='Connected Socket.IO clients (default 5)')
+    parser.add_argument('--mix', help='Scenario weights, e.g. home=50,support=5,chat=0')
+    parser.add_argument('--mpesa-latency', type=float, default=200, help='Fake Daraja latency in ms (default 200)')
+    parser.add_argument('--mpesa-jitter', type=float, default=100, help='Extra random Daraja latency in ms (default 100)')
+    parser.add_argument('--mpesa-failure-rate', type=float, default=0.05,
+                        help='Fraction of STK pushes that fail with 503 (default 0.05)')
+    parser.add_argument('--timeout', type=float, default=10, help='Per-request timeout in seconds (default 10)')
+    parser.add_argument('--worker-class', default='eventlet',
+                        help='Gunicorn worker class (default eventlet, as deployed; gthread also works)')
+    parser.add_argument('--port', type=int, help='Port for the app under test (default: any free port)')
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout')
+    parser.add_argument('--keep-workdir', action='store_true', help='Keep the temporary data copies and server log')
+    parser.add_argument('--max-error-rate', type=float, default=0,
+                        help='Exit non-zero if any route fails more often than this fraction (default 0)')
+    args = parser.parse_args()
+
+    results = run(args)
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    failing = [route for route, stats in results['routes'].items()
+               if stats['errors'] > args.max_error_rate * stats['requests']]
+    if failing:
+        print(f"Error rate above {args.max_error_rate} on: {', '.join(failing)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()